@@ -0,0 +1,213 @@
+'''
+Offline benchmark of the HuBERT encoder, the k-means assignment and the CodeHiFiGAN vocoder.
+
+Randomly initialized models of a configurable size are built in a temporary directory, so no checkpoint
+is downloaded, and every case reports the real-time factor (seconds of compute per second of audio),
+peak memory and per-stage timings as JSON:
+
+    python benchmark/benchmark.py --lengths 1 10 30 --batches 1 8 --output results.json
+    python benchmark/benchmark.py --baseline results.json
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DTOKENIZER_OFFLINE', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import torch
+from transformers import HubertConfig, HubertModel, Wav2Vec2FeatureExtractor
+
+from dtokenizer.audio.autotune import reset_rss_peak, rss_peak, device_name
+from dtokenizer.audio.model.hubert_model.modeling_hubert import _Speech2Code
+from dtokenizer.audio.vocoder.hifigan import CodeHiFiGANModel, ScriptedCodeHiFiGANVocoder, export_hifigan, \
+    load_hifigan
+from dtokenizer.metrics import metrics
+
+SAMPLING_RATE = 16000
+# HuBERT frames and vocoder codes are 20 ms each
+FRAME_RATE = 50
+
+
+def build_models(root, hidden_size, layers, clusters, vocoder_channels, seed=0):
+    '''Save a random HuBERT, its centroids and a CodeHiFiGAN under root, returning their paths.'''
+    torch.manual_seed(seed)
+    config = HubertConfig(hidden_size=hidden_size, num_hidden_layers=layers,
+                          num_attention_heads=max(1, hidden_size // 64), intermediate_size=hidden_size * 4)
+    hubert_path = os.path.join(root, 'hubert')
+    HubertModel(config).save_pretrained(hubert_path)
+    Wav2Vec2FeatureExtractor(do_normalize=False).save_pretrained(hubert_path)
+
+    km_path = os.path.join(root, 'centroids.npy')
+    np.save(km_path, np.random.RandomState(seed).randn(clusters, hidden_size).astype(np.float32))
+
+    vocoder_cfg = {"upsample_rates": [5, 4, 4, 2, 2], "upsample_kernel_sizes": [11, 8, 8, 4, 4],
+                   "upsample_initial_channel": vocoder_channels, "resblock_kernel_sizes": [3, 7, 11],
+                   "resblock_dilation_sizes": [[1, 3, 5], [1, 3, 5], [1, 3, 5]], "num_embeddings": clusters,
+                   "embedding_dim": 128, "model_in_dim": 128,
+                   "dur_predictor_params": {"encoder_embed_dim": 128, "var_pred_hidden_dim": 128,
+                                            "var_pred_kernel_size": 3, "var_pred_dropout": 0.5}}
+    vocoder_path = os.path.join(root, 'vocoder.pt')
+    torch.save({'generator': CodeHiFiGANModel(vocoder_cfg).state_dict()}, vocoder_path)
+    return hubert_path, km_path, vocoder_path, vocoder_cfg
+
+
+def _synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def measure(fn, repeat):
+    '''
+    Median and minimum wall time of fn over repeat runs after one warm-up, the peak memory and the mean
+    time per run of every stage recorded by dtokenizer.metrics.
+    '''
+    fn()
+    metrics.reset()
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+    else:
+        reset_rss_peak()
+    times = []
+    for _ in range(repeat):
+        _synchronize()
+        start = time.perf_counter()
+        fn()
+        _synchronize()
+        times.append(time.perf_counter() - start)
+    peak = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else rss_peak()
+    stages = {name: stats['seconds'] / repeat for name, stats in metrics.snapshot().items()}
+    return statistics.median(times), min(times), peak, stages
+
+
+def bench_speech2code(hubert_path, km_path, layer, lengths, batches, repeat, quantize=False):
+    results = []
+    for batch in batches:
+        sc = _Speech2Code(hubert_path, km_path, layer, batch=batch, quantize=quantize)
+        for length in lengths:
+            speech = [torch.randn(int(length * SAMPLING_RATE)) * 0.1 for _ in range(batch)]
+            for beamsearch in [False, True]:
+                median, best, peak, stages = measure(lambda: sc(input_values=speech, beamsearch=beamsearch), repeat)
+                results.append(_result('speech2code', length, batch, median, best, peak, stages,
+                                       beamsearch=beamsearch, quantize=quantize))
+        sc.close()
+    return results
+
+
+def bench_process_feature(hubert_path, km_path, layer, lengths, repeat, quantize=False):
+    sc = _Speech2Code(hubert_path, km_path, layer, batch=1, quantize=quantize)
+    results = []
+    for length in lengths:
+        feature = torch.randn(int(length * FRAME_RATE), sc.C.shape[0], device=sc.device)
+        for beamsearch in [False, True]:
+            median, best, peak, stages = measure(lambda: sc._process_feature(feature, beamsearch=beamsearch),
+                                                 repeat)
+            results.append(_result('process_feature', length, 1, median, best, peak, stages,
+                                   beamsearch=beamsearch, quantize=quantize))
+    sc.close()
+    return results
+
+
+def bench_vocoder(vocoder_path, vocoder_cfg, clusters, lengths, batches, repeat, scripted=False):
+    vocoder = load_hifigan(vocoder_path, vocoder_cfg)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if scripted:
+        vocoder = ScriptedCodeHiFiGANVocoder(export_hifigan(vocoder, vocoder_path + '.scripted.pt'), device)
+    vocoder = vocoder.to(device)
+    results = []
+    for batch in batches:
+        for length in lengths:
+            codes = [torch.randint(clusters, [int(length * FRAME_RATE)], device=device) for _ in range(batch)]
+            for dur_prediction in [False, True]:
+                def run():
+                    with torch.no_grad():
+                        if batch == 1:
+                            return vocoder({'code': codes[0].view(1, -1)}, dur_prediction=dur_prediction)
+                        return vocoder.batch_forward(codes, dur_prediction=dur_prediction)
+
+                median, best, peak, stages = measure(run, repeat)
+                results.append(_result('vocoder', length, batch, median, best, peak, stages,
+                                       dur_prediction=dur_prediction, scripted=scripted))
+    return results
+
+
+def _result(stage, length, batch, median, best, peak, stages=None, **options):
+    audio_sec = length * batch
+    return {'stage': stage, 'length_sec': length, 'batch': batch, 'options': options,
+            'median_sec': median, 'min_sec': best, 'rtf': median / audio_sec, 'peak_bytes': peak,
+            'stages_sec': stages or {}}
+
+
+def _case(result):
+    options = ','.join(f"{k}={v}" for k, v in sorted(result['options'].items()))
+    return f"{result['stage']}[{options}] len={result['length_sec']}s batch={result['batch']}"
+
+
+def compare(results, baseline):
+    '''Print the change in real-time factor of every case found in both runs.'''
+    previous = {_case(r): r for r in baseline['results']}
+    for result in results:
+        if _case(result) in previous:
+            ratio = result['rtf'] / previous[_case(result)]['rtf']
+            print(f"{_case(result)}: rtf {result['rtf']:.4f} ({ratio - 1:+.1%})", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lengths', type=float, nargs='+', default=[1, 10, 30], help='input lengths in seconds')
+    parser.add_argument('--batches', type=int, nargs='+', default=[1, 8], help='utterances per call')
+    parser.add_argument('--stages', nargs='+', default=['speech2code', 'process_feature', 'vocoder'],
+                        choices=['speech2code', 'process_feature', 'vocoder'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--hidden-size', type=int, default=256)
+    parser.add_argument('--layers', type=int, default=6)
+    parser.add_argument('--clusters', type=int, default=100)
+    parser.add_argument('--vocoder-channels', type=int, default=128)
+    parser.add_argument('--threads', type=int, default=None, help='torch CPU threads')
+    parser.add_argument('--quantize', action='store_true', help='int8 dynamic-quantized encoder on CPU')
+    parser.add_argument('--scripted-vocoder', action='store_true', help='TorchScript graphs of the vocoder')
+    parser.add_argument('--output', help='JSON file for the results, printed to stdout by default')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    args = parser.parse_args(argv)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    metrics.enable(synchronize=True)
+
+    results = []
+    with tempfile.TemporaryDirectory() as root:
+        hubert_path, km_path, vocoder_path, vocoder_cfg = build_models(
+            root, args.hidden_size, args.layers, args.clusters, args.vocoder_channels)
+        if 'speech2code' in args.stages:
+            results += bench_speech2code(hubert_path, km_path, args.layers, args.lengths, args.batches, args.repeat,
+                                         quantize=args.quantize)
+        if 'process_feature' in args.stages:
+            results += bench_process_feature(hubert_path, km_path, args.layers, args.lengths, args.repeat,
+                                             quantize=args.quantize)
+        if 'vocoder' in args.stages:
+            results += bench_vocoder(vocoder_path, vocoder_cfg, args.clusters, args.lengths, args.batches,
+                                     args.repeat, scripted=args.scripted_vocoder)
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    report = {'environment': {'device': device_name(device), 'torch': torch.__version__,
+                              'python': platform.python_version(), 'platform': platform.platform()},
+              'models': {k: getattr(args, k) for k in ['hidden_size', 'layers', 'clusters', 'vocoder_channels']},
+              'repeat': args.repeat, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
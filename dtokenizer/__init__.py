@@ -1,2 +1,10 @@
-import dtokenizer.audio
-import dtokenizer.image
\ No newline at end of file
+import importlib
+
+# submodules are imported on first access, so importing dtokenizer does not pull in any backend
+_SUBMODULES = ['audio', 'image']
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,163 @@
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from dtokenizer.metrics import metrics
+
+
+class AsyncBatcher(object):
+    '''
+    Coalesce concurrent awaited calls into batches. A batch is cut once max_batch calls are queued or the
+    oldest queued call has waited max_wait seconds, and batch_fn(items) runs on executor, returning one
+    result per item. Calls queue up while a batch runs, so the next one is usually full under load.
+    If a batch raises, its items are retried one by one, so an exception only reaches the call that caused it.
+    A batcher serves the event loop it is first awaited in.
+    '''
+
+    def __init__(self, batch_fn, executor, max_batch=16, max_wait=0.01, name='batch'):
+        if max_batch < 1:
+            raise ValueError(f"max_batch must be at least 1, got {max_batch}")
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self._pending = collections.deque()
+        # (item, future) of the batch on the executor
+        self._running = []
+        self._event = None
+        self._worker = None
+
+    async def __call__(self, item):
+        if self._worker is None:
+            self._event = asyncio.Event()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+        elif self._worker.done():
+            raise RuntimeError(f"{self.name} batcher is closed")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future, loop.time()))
+        self._event.set()
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        while not self._pending:
+            self._event.clear()
+            await self._event.wait()
+        deadline = self._pending[0][2] + self.max_wait
+        while len(self._pending) < self.max_batch:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+        # callers that gave up while queued
+        return [(item, future) for item, future, _ in batch if not future.cancelled()]
+
+    def _call(self, items):
+        # runs on the executor, (ok, result or exception) for every item
+        with metrics.stage(f"aio.{self.name}", batch=len(items)):
+            try:
+                results = list(self.batch_fn(items))
+                if len(results) != len(items):
+                    raise ValueError(f"{self.name} returned {len(results)} results for {len(items)} items")
+                return [(True, result) for result in results]
+            except Exception as e:
+                if len(items) == 1:
+                    return [(False, e)]
+        return [self._call([item])[0] for item in items]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                continue
+            self._running = batch
+            try:
+                outcomes = await loop.run_in_executor(self.executor, self._call, [item for item, _ in batch])
+            except Exception as e:
+                # the executor itself failed, e.g. it was shut down
+                outcomes = [(False, e)] * len(batch)
+            self._running = []
+            for (_, future), (ok, result) in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(result)
+                else:
+                    future.set_exception(result)
+
+    async def close(self):
+        '''Stop batching and fail the calls still queued or in the batch that is running.'''
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        futures = [future for _, future in self._running] + [future for _, future, _ in self._pending]
+        self._running = []
+        self._pending.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(RuntimeError(f"{self.name} batcher is closed"))
+
+
+class AsyncTokenizer(object):
+    '''
+    Asyncio front end of a tokenizer for services with many small concurrent requests. Concurrent encode,
+    encode_file and decode calls are micro-batched into the tokenizer's batch_encode, batch_file_encode
+    and batch_decode, which run one at a time on a dedicated thread, and each call gets its own result.
+    max_wait bounds the latency a call adds while waiting for others to join its batch.
+
+        tokenizer = AsyncTokenizer(HubertTokenizer('hubert_layer6_code100'), max_batch=16, max_wait=0.01)
+        code, _ = await tokenizer.encode(speech, 16000)
+    '''
+
+    def __init__(self, tokenizer, max_batch=16, max_wait=0.01, executor=None):
+        self.tokenizer = tokenizer
+        # one thread, the model runs one batch at a time and torch parallelizes within it
+        self._owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix='dtokenizer-aio')
+        self._encode = AsyncBatcher(self._encode_batch, self.executor, max_batch, max_wait, name='encode')
+        self._encode_file = AsyncBatcher(tokenizer.batch_file_encode, self.executor, max_batch, max_wait,
+                                         name='encode_file')
+        self._decode = AsyncBatcher(tokenizer.batch_decode, self.executor, max_batch, max_wait, name='decode')
+
+    def _encode_batch(self, items):
+        # one batch_encode per sampling rate, results in the order of items
+        by_rate = collections.defaultdict(list)
+        for i, (_, sampling_rate) in enumerate(items):
+            by_rate[sampling_rate].append(i)
+        results = [None] * len(items)
+        for sampling_rate, ids in by_rate.items():
+            for i, result in zip(ids, self.tokenizer.batch_encode([items[i][0] for i in ids], sampling_rate)):
+                results[i] = result
+        return results
+
+    async def encode(self, speech, sampling_rate):
+        return await self._encode((speech, sampling_rate))
+
+    async def encode_file(self, input_file):
+        return await self._encode_file(input_file)
+
+    async def decode(self, code):
+        return await self._decode(code)
+
+    async def close(self):
+        for batcher in [self._encode, self._encode_file, self._decode]:
+            await batcher.close()
+        if self._owns_executor:
+            self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
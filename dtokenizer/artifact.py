@@ -0,0 +1,118 @@
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from dtokenizer.cache import CACHE_DIR, file_digest
+
+ARTIFACT_DIR = os.environ.get('DTOKENIZER_ARTIFACTS', os.path.join(CACHE_DIR, 'artifacts'))
+
+
+def offline():
+    # no downloads at all, only artifacts that are already installed
+    return any(os.environ.get(name, '0') not in ('', '0') for name in ['DTOKENIZER_OFFLINE', 'HF_HUB_OFFLINE'])
+
+
+@contextmanager
+def locked(path):
+    # exclusive lock on path across processes, held in path + '.lock'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _read_record(path):
+    try:
+        with open(path + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_record(path, record):
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump(record, f)
+    os.replace(path + '.json.tmp', path + '.json')
+
+
+def _installed(path, sha256):
+    '''An artifact is installed when its record matches the file on disk and the expected checksum.'''
+    record = _read_record(path)
+    if record is None or not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    if record['size'] != stat.st_size or record['mtime'] != stat.st_mtime:
+        # modified since it was installed, verify the content again
+        if file_digest(path) != record['sha256']:
+            return False
+        record.update(size=stat.st_size, mtime=stat.st_mtime)
+        _write_record(path, record)
+    return sha256 is None or record['sha256'] == sha256
+
+
+def _install(path, build, sha256=None, source=None):
+    '''Build an artifact in a temporary file next to path, verify it and move it into place atomically.'''
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        tmp_path = os.path.join(tmp_dir, os.path.basename(path))
+        build(tmp_path)
+        digest = file_digest(tmp_path)
+        if sha256 is not None and digest != sha256:
+            raise ValueError(f"checksum mismatch for {source or path}: expected {sha256}, got {digest}")
+        os.replace(tmp_path, path)
+        stat = os.stat(path)
+        _write_record(path, {'sha256': digest, 'size': stat.st_size, 'mtime': stat.st_mtime, 'source': source})
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return path
+
+
+def fetch(url, name, sha256=None):
+    '''
+    Local path of the artifact downloaded from url, stored once under ARTIFACT_DIR/name.
+    Installs are locked across processes and verified against sha256 when given, otherwise the checksum
+    recorded at install time guards against later corruption.
+    '''
+    path = os.path.join(ARTIFACT_DIR, name)
+    with locked(path):
+        if _installed(path, sha256):
+            return path
+        if offline():
+            raise FileNotFoundError(f"artifact {name} is not installed in {ARTIFACT_DIR} and downloads are disabled")
+
+        def download(tmp_path):
+            import nlp2
+            nlp2.download_file(url, os.path.dirname(tmp_path), os.path.basename(tmp_path))
+
+        return _install(path, download, sha256=sha256, source=url)
+
+
+def derive(name, build, source=None):
+    '''
+    Local path of an artifact computed from others, e.g. a converted model, stored under ARTIFACT_DIR/name.
+    build(path) writes it once; other processes wait on the lock and reuse the result.
+    '''
+    path = os.path.join(ARTIFACT_DIR, name)
+    with locked(path):
+        if _installed(path, None):
+            return path
+        return _install(path, build, source=source)
+
+
+def fetch_centroids(url, name, sha256=None):
+    '''
+    Path of the k-means centroids of the model at url as a .npy array, which np.load can memory-map.
+    The pickled k-means model is only loaded once, to extract its cluster_centers_.
+    '''
+    km_path = fetch(url, name, sha256=sha256)
+
+    def convert(tmp_path):
+        import joblib
+        import numpy as np
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(joblib.load(km_path).cluster_centers_))
+
+    return derive(name + '.centroids.npy', convert, source=url)
@@ -1 +1 @@
-from dtokenizer.audio.model import *
\ No newline at end of file
+from dtokenizer.audio.model import __getattr__, __all__
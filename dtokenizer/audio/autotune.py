@@ -0,0 +1,174 @@
+import json
+import os
+import platform
+import resource
+import socket
+import time
+
+import torch
+
+from dtokenizer.artifact import locked
+from dtokenizer.cache import CACHE_DIR
+
+
+def _cache_path():
+    return os.path.join(CACHE_DIR, 'autotune.json')
+
+
+def _read_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(path, key, value):
+    # locked, so processes starting together do not drop each other's entries
+    with locked(path):
+        cache = _read_cache(path)
+        cache[key] = value
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+
+
+def _out_of_memory(error):
+    # CUDA raises OutOfMemoryError, the CPU allocator a plain RuntimeError
+    message = str(error).lower()
+    return isinstance(error, torch.OutOfMemoryError) or 'out of memory' in message or \
+        "can't allocate memory" in message
+
+
+def device_name(device):
+    if str(device).startswith('cuda'):
+        return f"cuda:{torch.cuda.get_device_name(device)}"
+    return f"cpu:{platform.processor() or platform.machine()}:{torch.get_num_threads()}threads"
+
+
+def _read_status(field):
+    # values in /proc/self/status are reported in kB
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_rss_peak():
+    # start a new peak for rss_peak(), where the kernel allows it
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def rss_peak():
+    # highest resident set size since the last reset_rss_peak(), in bytes
+    peak = _read_status('VmHWM')
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak
+
+
+def cpu_memory_limit():
+    '''Bytes this process may grow to: available memory plus current RSS, capped by the cgroup limit.'''
+    limit = None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    limit = int(line.split()[1]) * 1024 + (_read_status('VmRSS') or 0)
+    except OSError:
+        pass
+    for cgroup_file in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        try:
+            with open(cgroup_file) as f:
+                value = f.read().strip()
+            if value.isdigit():
+                limit = int(value) if limit is None else min(limit, int(value))
+                break
+        except OSError:
+            continue
+    return limit
+
+
+def _measure(forward, batch, chunk_length, device):
+    inputs = torch.rand([batch, chunk_length], device=device)
+    if str(device).startswith('cuda'):
+        torch.cuda.reset_peak_memory_stats(device)
+        torch.cuda.synchronize(device)
+    else:
+        reset_rss_peak()
+    start = time.perf_counter()
+    forward(inputs)
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize(device)
+        peak = torch.cuda.max_memory_allocated(device)
+    else:
+        peak = rss_peak()
+    elapsed = time.perf_counter() - start
+    return batch * chunk_length / elapsed, peak
+
+
+def autotune_batch(forward, chunk_length, device, key, max_batch=64, memory_fraction=0.8, min_gain=1.05,
+                   use_cache=True):
+    '''
+    Find the batch size with the best throughput for forward() on [batch, chunk_length] inputs.
+    Batches double from 1 while throughput improves by at least min_gain and the projected peak memory
+    of the next step stays within memory_fraction of the device (GPU memory, or RSS limit on CPU).
+    The result is cached per host under key, so later runs skip the probe.
+    '''
+    path = _cache_path()
+    key = f"{socket.gethostname()}|{device_name(device)}|torch-{torch.__version__}|{key}"
+    if use_cache:
+        cached = _read_cache(path).get(key)
+        if cached:
+            return cached['batch']
+
+    is_cuda = str(device).startswith('cuda')
+    if is_cuda:
+        limit = torch.cuda.get_device_properties(device).total_memory
+        base = torch.cuda.memory_allocated(device)
+    else:
+        limit = cpu_memory_limit()
+        base = _read_status('VmRSS') or rss_peak()
+    budget = limit * memory_fraction if limit else None
+
+    probes = {}
+    best_batch, best_throughput = 1, 0.0
+    with torch.no_grad():
+        # warm up kernels and allocator before timing
+        forward(torch.rand([1, chunk_length], device=device))
+        batch = 1
+        while batch <= max_batch:
+            try:
+                throughput, peak = _measure(forward, batch, chunk_length, device)
+            except RuntimeError as e:
+                if not _out_of_memory(e):
+                    raise
+                break
+            finally:
+                if is_cuda:
+                    torch.cuda.empty_cache()
+            probes[batch] = {'samples_per_sec': throughput, 'peak_bytes': peak}
+            if throughput > best_throughput:
+                improved = throughput >= best_throughput * min_gain
+                best_batch, best_throughput = batch, throughput
+                if not improved:
+                    break
+            else:
+                break
+            # memory grows about linearly with the batch, so doubling doubles what the batch adds
+            if budget and base + (peak - base) * 2 > budget:
+                break
+            batch *= 2
+
+    if use_cache:
+        _write_cache(path, key, {'batch': best_batch, 'chunk_length': chunk_length, 'probes': probes})
+    return best_batch
@@ -1,3 +1,18 @@
-from dtokenizer.audio.model.hubert_model import *
-from dtokenizer.audio.model.encodec_model import *
-from dtokenizer.audio.model.semanticodec_model import *
+import importlib
+
+# tokenizer classes and the module defining them, imported on first use
+_TOKENIZERS = {
+    'HubertTokenizer': 'dtokenizer.audio.model.hubert_model',
+    'HubertMultiTokenizer': 'dtokenizer.audio.model.hubert_model',
+    'HubertTokenizerPool': 'dtokenizer.audio.model.hubert_model',
+    'EncodecTokenizer': 'dtokenizer.audio.model.encodec_model',
+    'SemanticodecTokenizer': 'dtokenizer.audio.model.semanticodec_model',
+}
+
+__all__ = list(_TOKENIZERS)
+
+
+def __getattr__(name):
+    if name in _TOKENIZERS:
+        return getattr(importlib.import_module(_TOKENIZERS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,8 +1,5 @@
-import soundfile
-import torch
-
 from dtokenizer.interface import BaseTokenizer
-from SoundCodec import codec
+from dtokenizer.metrics import metrics
 
 CONFIG = {
     "encodec_24k_1_5bps": "encodec_24k_1_5bps",
@@ -15,21 +12,36 @@ CONFIG = {
 
 class EncodecTokenizer(BaseTokenizer):
     def __init__(self, config):
-        self.model = codec.load_codec(config)
+        self.config = config
+        self._model = None
+
+    @property
+    def model(self):
+        # SoundCodec and the codec weights are loaded on the first encode/decode
+        if self._model is None:
+            from SoundCodec import codec
+            self._model = codec.load_codec(self.config)
+        return self._model
 
     def encode(self, input_array, sampling_rate):
         data_item = {'audio': {'array': input_array,
                                'sampling_rate': sampling_rate}}
-        unit_item = self.model.extract_unit(data_item)
+        with metrics.stage('encodec.encode', samples=len(input_array)):
+            unit_item = self.model.extract_unit(data_item)
         return unit_item.unit,unit_item.stuff_for_synth
 
     def encode_file(self, input_file):
+        import soundfile
         # read audio file into array and sampling_rate
-        input_array, sampling_rate = soundfile.read(input_file)
+        with metrics.stage('encodec.load') as stage:
+            input_array, sampling_rate = soundfile.read(input_file)
+            stage.update(samples=len(input_array), bytes=input_array.nbytes)
         data_item = {'audio': {'array': input_array,
                                'sampling_rate': sampling_rate}}
-        unit_item = self.model.extract_unit(data_item)
+        with metrics.stage('encodec.encode', samples=len(input_array)):
+            unit_item = self.model.extract_unit(data_item)
         return unit_item.unit,unit_item.stuff_for_synth
 
     def decode(self, stuff_for_decode):
-        return self.model.decode_unit(stuff_for_decode)
+        with metrics.stage('encodec.decode'):
+            return self.model.decode_unit(stuff_for_decode)
@@ -1,2 +1 @@
-
-from .configuration_hubert import HubertTokenizer
+from .configuration_hubert import HubertTokenizer, HubertMultiTokenizer, HubertTokenizerPool
@@ -1,27 +1,82 @@
-import os
-import nlp2
+import json
 
+from dtokenizer.artifact import fetch, fetch_centroids
 from dtokenizer.interface import BaseTokenizer
-from .modeling_hubert import _Speech2Code, _Code2Speech
-import torchaudio
 
 
 class HubertTokenizer(BaseTokenizer):
-    def __init__(self, config):
+    def __init__(self, config, scripted_vocoder=False, **kwargs):
         self.sampling_rate = 16000
         if config in CONFIG:
-            self.sc, self.cs = CONFIG[config]()
+            self.config = config
+            self.kwargs = kwargs
+            self.scripted_vocoder = scripted_vocoder
+            self._sc = None
+            self._cs = None
         else:
             raise ValueError(f"config {config} not found in {CONFIG.keys()}")
 
+    # weights are loaded on the first encode/decode, not when the tokenizer is built, and decoding
+    # never loads the encoder nor encoding the vocoder
+    @property
+    def sc(self):
+        if self._sc is None:
+            self._sc = CONFIG[self.config](**self.kwargs)
+        return self._sc
+
+    @property
+    def cs(self):
+        if self._cs is None and self.config in VOCODERS:
+            self._cs = VOCODERS[self.config](scripted_vocoder=self.scripted_vocoder)
+        return self._cs
+
+    def _load(self):
+        return self.sc, self.cs
+
+    def close(self):
+        # release the shared backbone, centroids and vocoder once no other tokenizer uses them
+        if self._sc is not None:
+            self._sc.close()
+        if self._cs is not None:
+            self._cs.close()
+
     def encode(self, speech, sampling_rate):
+        import torchaudio
         # if sampling_rate is not 16000
         if sampling_rate != self.sampling_rate:
             speech = torchaudio.functional.resample(speech, sampling_rate, self.sampling_rate)
         return self.sc(input_values=speech), None
 
-    def encode_file(self, input_file):
-        return self.sc(filepaths=[input_file])['code'], None
+    def encode_file(self, input_file, feat_norm=False, beamsearch=False, top_k=5, beamsize=5):
+        result = self.sc(filepaths=[input_file], feat_norm=feat_norm, beamsearch=beamsearch, top_k=top_k,
+                         beamsize=beamsize)
+        return result['beam_code' if beamsearch else 'code'], None
+
+    def batch_encode(self, speeches, sampling_rate):
+        # one call, so speeches share padded forward passes
+        import torchaudio
+        if sampling_rate != self.sampling_rate:
+            speeches = [torchaudio.functional.resample(speech, sampling_rate, self.sampling_rate)
+                        for speech in speeches]
+        results = self.sc(input_values=list(speeches))
+        return [(result, None) for result in ([results] if len(speeches) == 1 else results)]
+
+    def batch_file_encode(self, input_files, feat_norm=False, beamsearch=False, top_k=5, beamsize=5):
+        results = self.sc(filepaths=list(input_files), feat_norm=feat_norm, beamsearch=beamsearch, top_k=top_k,
+                          beamsize=beamsize)
+        if len(input_files) == 1:
+            results = [results]
+        return [(result['beam_code' if beamsearch else 'code'], None) for result in results]
+
+    def iter_encode_file(self, input_file):
+        # long recordings, codes are yielded window by window with constant memory
+        for result in self.sc.iter_file(input_file):
+            yield result['code']
+
+    def stream(self, sampling_rate=16000, step_sec=0.5, left_context_sec=2.0, right_context_sec=0.5):
+        # session for live audio, feed() PCM blocks as they arrive and get back the codes that are final
+        return self.sc.stream(sampling_rate=sampling_rate, step_sec=step_sec,
+                              left_context_sec=left_context_sec, right_context_sec=right_context_sec)
 
     def decode(self, code):
         if not self.cs:
@@ -29,98 +84,298 @@ class HubertTokenizer(BaseTokenizer):
         else:
             return self.cs(code)
 
+    def stream_decode(self, code, chunk_frames=10):
+        # waveform blocks of chunk_frames vocoder frames (20 ms each at 16k), yielded as they are synthesized
+        if not self.cs:
+            raise ValueError("No hubert vocoder is available")
+        else:
+            return self.cs.stream(code, chunk_frames=chunk_frames)
+
+    def batch_decode(self, codes):
+        if not self.cs:
+            raise ValueError("No hubert vocoder is available")
+        else:
+            return self.cs.batch_decode(codes)
+
+    def quantization_report(self, input_files):
+        # code agreement and speed of quantize=True against fp32 on these files
+        import inspect
+        from .modeling_hubert import _Speech2Code, quantization_report
+        # both encoders run on the torch backend, so only the arguments _Speech2Code takes apply
+        parameters = inspect.signature(_Speech2Code).parameters
+        kwargs = {k: v for k, v in self.kwargs.items() if k in parameters and k != 'quantize'}
+        return quantization_report(*KMEANS[self.config](), filepaths=list(input_files), **kwargs)
+
+
+class HubertMultiTokenizer(BaseTokenizer):
+    """Codes of several configs sharing one backbone, from a single forward pass per batch."""
+
+    def __init__(self, configs, sampling_rate=16000, chunk_sec=10, worker=8, return_diff=False, batch=None,
+                 quantize=False):
+        self.sampling_rate = 16000
+        for config in configs:
+            if config not in KMEANS:
+                raise ValueError(f"config {config} not found in {KMEANS.keys()}")
+        self.configs = list(configs)
+        self.kwargs = dict(sampling_rate=sampling_rate, chunk_sec=chunk_sec, worker=worker,
+                           return_diff=return_diff, batch=batch, quantize=quantize)
+        self._sc = None
+
+    @property
+    def sc(self):
+        if self._sc is None:
+            from .modeling_hubert import _MultiSpeech2Code
+            specs = {config: KMEANS[config]() for config in self.configs}
+            backbones = {hubert_model for hubert_model, _, _ in specs.values()}
+            if len(backbones) != 1:
+                raise ValueError(f"configs {self.configs} do not share one backbone: {backbones}")
+            heads = {config: (km_path, km_layer) for config, (_, km_path, km_layer) in specs.items()}
+            self._sc = _MultiSpeech2Code(backbones.pop(), heads, **self.kwargs)
+        return self._sc
+
+    def close(self):
+        if self._sc is not None:
+            self._sc.close()
+
+    def encode(self, speech, sampling_rate):
+        import torchaudio
+        if sampling_rate != self.sampling_rate:
+            speech = torchaudio.functional.resample(speech, sampling_rate, self.sampling_rate)
+        return self.sc(input_values=speech), None
+
+    def encode_file(self, input_file, feat_norm=False, beamsearch=False, top_k=5, beamsize=5):
+        result = self.sc(filepaths=[input_file], feat_norm=feat_norm, beamsearch=beamsearch, top_k=top_k,
+                         beamsize=beamsize)
+        return {config: head['beam_code' if beamsearch else 'code'] for config, head in result.items()}, None
+
+
+# tokenizer of a HubertTokenizerPool worker process
+_pool_tokenizer = None
+
+
+def _pool_init(config, kwargs, shared, threads):
+    global _pool_tokenizer
+    import torch
+    from dtokenizer.audio.registry import shared_registry
+    from .modeling_hubert import load_shared
+    torch.set_num_threads(threads)
+    # the parent's weights, so building the tokenizer attaches to them instead of loading a copy
+    for key, state_dict in shared.items():
+        shared_registry.acquire(key, lambda: load_shared(key, state_dict))
+    _pool_tokenizer = HubertTokenizer(config, **kwargs)
+    _pool_tokenizer._load()
+
+
+def _pool_encode_file(task):
+    input_file, encode_args = task
+    return _pool_tokenizer.encode_file(input_file, **encode_args)
+
+
+def _pool_decode(code):
+    return _pool_tokenizer.decode(code).numpy()
+
+
+class HubertTokenizerPool(object):
+    """
+    A HubertTokenizer config run by several CPU processes that share one copy of its weights. The parent
+    loads the backbone and vocoder once and moves their weights to shared memory, and workers build
+    their models around those tensors instead of loading a copy, so every extra worker mostly adds its
+    activations to the RSS. Centroids are memory-mapped by each worker; int8 backbones, ONNX sessions
+    and TorchScript vocoders are loaded by each worker from their cached files. Work is distributed one
+    file (or code sequence) at a time, and results come back in input order.
+    """
+
+    def __init__(self, config, workers=None, threads=1, start_method='spawn', **kwargs):
+        import os
+        import torch.multiprocessing
+        from .modeling_hubert import share_entry
+        # DataLoader processes inside every worker would oversubscribe the cores the pool already uses
+        kwargs.setdefault('worker', 0)
+        self.tokenizer = HubertTokenizer(config, **kwargs)
+        sc, cs = self.tokenizer._load()
+        if sc.device != 'cpu':
+            raise ValueError("HubertTokenizerPool shares CPU memory, on a GPU batch with HubertTokenizer instead")
+        # workers run with other thread counts, which autotune keys its cache on, so they would each probe
+        kwargs.setdefault('batch', sc.max_batch)
+        shared = {}
+        for key in sc.registry_keys + (cs.registry_keys if cs else []):
+            state_dict = share_entry(key)
+            if state_dict is not None:
+                shared[key] = state_dict
+        self.workers = workers or os.cpu_count() or 1
+        context = torch.multiprocessing.get_context(start_method)
+        self.pool = context.Pool(self.workers, _pool_init, (config, kwargs, shared, threads))
+
+    def encode_files(self, input_files, **encode_args):
+        """encode_file of every file, in the order of input_files."""
+        return self.pool.map(_pool_encode_file, [(input_file, encode_args) for input_file in input_files],
+                             chunksize=1)
+
+    def imap_encode_files(self, input_files, **encode_args):
+        """Like encode_files, yielding each result as soon as it and the ones before it are done."""
+        return self.pool.imap(_pool_encode_file, [(input_file, encode_args) for input_file in input_files])
+
+    def batch_decode(self, codes):
+        """Waveforms of every code sequence as numpy arrays, in the order of codes."""
+        return self.pool.map(_pool_decode, codes, chunksize=1)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.tokenizer.close()
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.tokenizer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+def hubert_layer6_code50_kmeans():
+    km_path = fetch_centroids('https://dl.fbaipublicfiles.com/textless_nlp/gslm/hubert/km50/km.bin',
+                              'hubert_base_ls960_L6_km50.bin')
+    return "facebook/hubert-base-ls960", km_path, 6
+
 
 def hubert_layer6_code50(sampling_rate=16000,
                          chunk_sec=10,
                          worker=8,
                          return_diff=False,
-                         batch=None):
-    nlp2.download_file(
-        'https://dl.fbaipublicfiles.com/textless_nlp/gslm/hubert/km50/km.bin', './')
-    if not os.path.exists('./hubert_base_ls960_L6_km50.bin'):
-        os.rename('./km.bin', './hubert_base_ls960_L6_km50.bin')
-    sc = _Speech2Code("facebook/hubert-base-ls960", './hubert_base_ls960_L6_km50.bin', 6,
-                      sampling_rate=sampling_rate,
-                      chunk_sec=chunk_sec,
-                      worker=worker,
-                      return_diff=return_diff,
-                      batch=batch)
-    return sc, None
+                         batch=None,
+                         quantize=False,
+                         backend='torch'):
+    from .modeling_hubert import load_speech2code
+    sc = load_speech2code(*hubert_layer6_code50_kmeans(),
+                          sampling_rate=sampling_rate,
+                          chunk_sec=chunk_sec,
+                          worker=worker,
+                          return_diff=return_diff,
+                          batch=batch,
+                          quantize=quantize,
+                          backend=backend)
+    return sc
+
+
+def hubert_layer6_code100_kmeans():
+    km_path = fetch_centroids('https://dl.fbaipublicfiles.com/textless_nlp/gslm/hubert/km100/km.bin',
+                              'hubert_base_ls960_L6_km100.bin')
+    return "facebook/hubert-base-ls960", km_path, 6
 
 
 def hubert_layer6_code100(sampling_rate=16000,
                           chunk_sec=10,
                           worker=8,
                           return_diff=False,
-                          batch=None):
+                          batch=None,
+                          quantize=False,
+                          backend='torch'):
     # https://github.com/facebookresearch/fairseq/blob/ust/examples/speech_to_speech/docs/direct_s2st_discrete_units.md
-    nlp2.download_file(
-        'https://dl.fbaipublicfiles.com/textless_nlp/gslm/hubert/km100/km.bin', './')
-    os.rename('./km.bin', './hubert_base_ls960_L6_km100.bin')
-    nlp2.download_file(
+    from .modeling_hubert import load_speech2code
+    sc = load_speech2code(*hubert_layer6_code100_kmeans(),
+                          sampling_rate=sampling_rate,
+                          chunk_sec=chunk_sec,
+                          worker=worker,
+                          return_diff=return_diff,
+                          batch=batch,
+                          quantize=quantize,
+                          backend=backend)
+    return sc
+
+
+def hubert_layer6_code100_vocoder(scripted_vocoder=False):
+    from .modeling_hubert import _Code2Speech
+    vocoder_path = fetch(
         'https://dl.fbaipublicfiles.com/fairseq/speech_to_speech/vocoder/code_hifigan/hubert_base_100_lj/g_00500000',
-        './', 'hifigan_hubert_layer6_code100_g_00500000')
-    nlp2.download_file(
+        'hifigan_hubert_layer6_code100_g_00500000')
+    config_path = fetch(
         'https://dl.fbaipublicfiles.com/fairseq/speech_to_speech/vocoder/code_hifigan/hubert_base_100_lj/config.json',
-        './', 'hifigan_hubert_layer6_code100_config.json')
-    sc = _Speech2Code("facebook/hubert-base-ls960", './hubert_base_ls960_L6_km100.bin', 6,
-                      sampling_rate=sampling_rate,
-                      chunk_sec=chunk_sec,
-                      worker=worker,
-                      return_diff=return_diff,
-                      batch=batch)
-    cs = _Code2Speech(tts_checkpoint='./hifigan_hubert_layer6_code100_g_00500000',
-                      model_cfg=nlp2.read_json('./hifigan_hubert_layer6_code100_config.json'))
-    return sc, cs
+        'hifigan_hubert_layer6_code100_config.json')
+    with open(config_path) as f:
+        model_cfg = json.load(f)
+    return _Code2Speech(tts_checkpoint=vocoder_path, model_cfg=model_cfg, scripted=scripted_vocoder)
+
+
+def hubert_layer6_code200_kmeans():
+    km_path = fetch_centroids('https://dl.fbaipublicfiles.com/textless_nlp/gslm/hubert/km200/km.bin',
+                              'hubert_base_ls960_L6_km200.bin')
+    return "facebook/hubert-base-ls960", km_path, 6
 
 
 def hubert_layer6_code200(sampling_rate=16000,
                           chunk_sec=10,
                           worker=8,
                           return_diff=False,
-                          batch=None):
-    nlp2.download_file(
-        'https://dl.fbaipublicfiles.com/textless_nlp/gslm/hubert/km200/km.bin', './')
-    os.rename('./km.bin', './hubert_base_ls960_L6_km200.bin')
-    sc = _Speech2Code("facebook/hubert-base-ls960", './hubert_base_ls960_L6_km200.bin', 6,
-                      sampling_rate=sampling_rate,
-                      chunk_sec=chunk_sec,
-                      worker=worker,
-                      return_diff=return_diff,
-                      batch=batch)
-    return sc, None
+                          batch=None,
+                          quantize=False,
+                          backend='torch'):
+    from .modeling_hubert import load_speech2code
+    sc = load_speech2code(*hubert_layer6_code200_kmeans(),
+                          sampling_rate=sampling_rate,
+                          chunk_sec=chunk_sec,
+                          worker=worker,
+                          return_diff=return_diff,
+                          batch=batch,
+                          quantize=quantize,
+                          backend=backend)
+    return sc
+
+
+def hubert_layer9_code500_kmeans():
+    km_path = fetch_centroids('https://dl.fbaipublicfiles.com/hubert/hubert_base_ls960_L9_km500.bin',
+                              'hubert_base_ls960_L9_km500.bin')
+    return "facebook/hubert-base-ls960", km_path, 9
 
 
 def hubert_layer9_code500(sampling_rate=16000,
                           chunk_sec=10,
                           worker=8,
                           return_diff=False,
-                          batch=None):
-    nlp2.download_file(
-        'https://dl.fbaipublicfiles.com/hubert/hubert_base_ls960_L9_km500.bin', './')
-    sc = _Speech2Code("facebook/hubert-base-ls960", './hubert_base_ls960_L9_km500.bin', 9,
-                      sampling_rate=sampling_rate,
-                      chunk_sec=chunk_sec,
-                      worker=worker,
-                      return_diff=return_diff,
-                      batch=batch)
-    return sc, None
+                          batch=None,
+                          quantize=False,
+                          backend='torch'):
+    from .modeling_hubert import load_speech2code
+    sc = load_speech2code(*hubert_layer9_code500_kmeans(),
+                          sampling_rate=sampling_rate,
+                          chunk_sec=chunk_sec,
+                          worker=worker,
+                          return_diff=return_diff,
+                          batch=batch,
+                          quantize=quantize,
+                          backend=backend)
+    return sc
+
+
+def zh_hubert_layer20_code2000_kmeans():
+    km_path = fetch_centroids('https://huggingface.co/anthony-wss/extract-ssl-bpe/resolve/main/km_2000.mdl',
+                              'chinese_hubert_large_L20_km2000.mdl')
+    return "TencentGameMate/chinese-hubert-large", km_path, 20
 
 
 def zh_hubert_layer20_code2000(sampling_rate=16000,
                                chunk_sec=10,
                                worker=8,
                                return_diff=False,
-                               batch=None):
-    nlp2.download_file(
-        'https://huggingface.co/anthony-wss/extract-ssl-bpe/resolve/main/km_2000.mdl', './')
-    sc = _Speech2Code("TencentGameMate/chinese-hubert-large", './km_2000.mdl', 20,
-                      sampling_rate=sampling_rate,
-                      chunk_sec=chunk_sec,
-                      worker=worker,
-                      return_diff=return_diff,
-                      batch=batch)
-    return sc, None
+                               batch=None,
+                               quantize=False,
+                               backend='torch'):
+    from .modeling_hubert import load_speech2code
+    sc = load_speech2code(*zh_hubert_layer20_code2000_kmeans(),
+                          sampling_rate=sampling_rate,
+                          chunk_sec=chunk_sec,
+                          worker=worker,
+                          return_diff=return_diff,
+                          batch=batch,
+                          quantize=quantize,
+                          backend=backend)
+    return sc
 
 
 CONFIG = {
@@ -130,3 +385,17 @@ CONFIG = {
     "hubert_layer9_code500": hubert_layer9_code500,
     "zh_hubert_layer20_code2000": zh_hubert_layer20_code2000,
 }
+
+# unit-to-speech vocoder of the configs that have one, built separately from their encoder
+VOCODERS = {
+    "hubert_layer6_code100": hubert_layer6_code100_vocoder,
+}
+
+# (backbone, k-means path, layer) of every config, used to put several configs on one backbone pass
+KMEANS = {
+    "hubert_layer6_code50": hubert_layer6_code50_kmeans,
+    "hubert_layer6_code100": hubert_layer6_code100_kmeans,
+    "hubert_layer6_code200": hubert_layer6_code200_kmeans,
+    "hubert_layer9_code500": hubert_layer9_code500_kmeans,
+    "zh_hubert_layer20_code2000": zh_hubert_layer20_code2000_kmeans,
+}
@@ -1,17 +1,23 @@
-import gc
+import copy
+import hashlib
+import json
+import math
+import os
+import time
+import weakref
 from collections import defaultdict
 from functools import partial
-from itertools import groupby
 
 import joblib
 import numpy as np
+import soundfile
 import torch
 import torchaudio
 from sklearn.exceptions import InconsistentVersionWarning
 from torch import nn
 from torch.utils.data import DataLoader, Dataset
 from tqdm.contrib.concurrent import thread_map
-from transformers import Wav2Vec2FeatureExtractor, HubertModel
+from transformers import Wav2Vec2FeatureExtractor, HubertConfig, HubertModel
 from transformers import logging
 
 logging.set_verbosity_error()
@@ -19,8 +25,14 @@ import warnings
 
 warnings.filterwarnings('ignore', category=UserWarning)
 warnings.filterwarnings("ignore", category=InconsistentVersionWarning)
-from dtokenizer.audio.utility import collate_fn_pad, chunks
-from dtokenizer.audio.vocoder.hifigan import load_hifigan
+from dtokenizer.artifact import derive, offline
+from dtokenizer.audio.autotune import autotune_batch
+from dtokenizer.audio.registry import shared_registry
+from dtokenizer.audio.utility import collate_fn_pad, length_batches, nearest_centroids, squared_distances, \
+    beam_search_units, StreamResampler, quantize_centroids
+from dtokenizer.audio.vocoder.hifigan import GRAPH_VERSION, export_hifigan, load_hifigan, load_scripted_hifigan
+from dtokenizer.metrics import metrics
+from dtokenizer.units import run_length
 
 
 class SpeechDataset(Dataset):
@@ -29,137 +41,472 @@ class SpeechDataset(Dataset):
         self.input_values = input_values
         self.processor = processor
         self.sampling_rate = sampling_rate
+        self.resamplers = {}
 
     def __getitem__(self, index):
         if index < len(self.paths):
-            speech, sr = torchaudio.load(self.paths[index])
+            with metrics.stage('speech2code.load') as stage:
+                speech, sr = torchaudio.load(self.paths[index])
+                stage.update(samples=speech.shape[-1], bytes=speech.numel() * speech.element_size())
         else:
             speech = self.input_values[index - len(self.paths)][None, :]
             sr = self.sampling_rate
 
         speech = speech.mean(0)
         if sr != self.sampling_rate:
-            resampler = torchaudio.transforms.Resample(orig_freq=sr, new_freq=self.sampling_rate)
-            speech = resampler.forward(speech.squeeze(0))
+            with metrics.stage('speech2code.resample', samples=speech.shape[-1]):
+                if sr not in self.resamplers:
+                    self.resamplers[sr] = torchaudio.transforms.Resample(orig_freq=sr, new_freq=self.sampling_rate)
+                speech = self.resamplers[sr].forward(speech.squeeze(0))
         else:
             speech = speech.squeeze(0)
-        input_values = self.processor(speech, return_tensors="pt",
-                                      sampling_rate=self.sampling_rate).input_values
+        with metrics.stage('speech2code.feature_extractor', samples=speech.shape[-1]):
+            input_values = self.processor(speech, return_tensors="pt",
+                                          sampling_rate=self.sampling_rate).input_values
         return input_values.squeeze(0)
 
     def __len__(self):
         return len(self.paths) + len(self.input_values)
 
+    def num_samples(self, index):
+        '''Length of an item after resampling, read from the file header without decoding it.'''
+        if index < len(self.paths):
+            info = torchaudio.info(self.paths[index])
+            return math.ceil(info.num_frames * self.sampling_rate / info.sample_rate)
+        return self.input_values[index - len(self.paths)].shape[-1]
+
+
+def export_scripted_hifigan(tts_checkpoint, model_cfg=None):
+    '''Path of the TorchScript graphs of the vocoder checkpoint, traced once and kept as an artifact.'''
+    stat = os.stat(tts_checkpoint)
+    spec = json.dumps([os.path.abspath(tts_checkpoint), stat.st_size, stat.st_mtime, model_cfg, torch.__version__,
+                       GRAPH_VERSION], sort_keys=True)
+    name = f"torchscript/{hashlib.sha256(spec.encode()).hexdigest()[:16]}.pt"
+    return derive(name, lambda tmp_path: export_hifigan(load_hifigan(tts_checkpoint, model_cfg), tmp_path),
+                  source=tts_checkpoint)
+
 
 class _Code2Speech(object):
-    def __init__(self, tts_checkpoint, model_cfg=None, end_tok=None, code_begin_pad=0):
+    def __init__(self, tts_checkpoint, model_cfg=None, end_tok=None, code_begin_pad=0, scripted=False):
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.sample_rate = 16000
-        self.hifigan = load_hifigan(model_path=tts_checkpoint, model_cfg=model_cfg)
+        # vocoders are shared by every _Code2Speech of the process loading the same checkpoint
+        key = ('hifigan', tts_checkpoint, json.dumps(model_cfg, sort_keys=True), scripted)
+        if scripted:
+            # traced graphs, which skip the Python model and its setup when loaded
+            self.hifigan = shared_registry.acquire(key, lambda: load_scripted_hifigan(
+                export_scripted_hifigan(tts_checkpoint, model_cfg)))
+        else:
+            self.hifigan = shared_registry.acquire(key, lambda: load_hifigan(model_path=tts_checkpoint,
+                                                                             model_cfg=model_cfg))
+        self.registry_keys = [key]
+        self._release = weakref.finalize(self, shared_registry.release, key)
         self.end_tok = end_tok
         self.code_begin_pad = code_begin_pad
 
+    def close(self):
+        self._release()
+
+    def _prepare(self, code):
+        code = [i + self.code_begin_pad for i in code]
+        if self.end_tok is not None and code[-1] != self.end_tok:
+            code.append(self.end_tok)
+        return torch.tensor(code, dtype=torch.long)
+
     def __call__(self, code, strength=0.1, dur_prediction=True):
-        with torch.no_grad():
-            code = [i + self.code_begin_pad for i in code]
-            if self.end_tok is not None and code[-1] != self.end_tok:
-                code.append(self.end_tok)
-            tts_input = torch.tensor(code, dtype=torch.long)
+        with torch.no_grad(), metrics.stage('code2speech.vocoder', batch=1, codes=len(code)) as stage:
+            tts_input = self._prepare(code)
             x = {
                 "code": tts_input.view(1, -1)
             }
             audio_seq = self.hifigan(x, dur_prediction=dur_prediction)
+            stage.update(samples=audio_seq.shape[-1])
 
             return audio_seq
 
+    def stream(self, code, dur_prediction=True, chunk_frames=10, context_frames=16):
+        """Yield the waveform in blocks of chunk_frames vocoder frames as soon as each is synthesized."""
+        tts_input = self._prepare(code)
+        x = {
+            "code": tts_input.view(1, -1)
+        }
+        yield from metrics.iterate('code2speech.stream', self.hifigan.stream(
+            x, dur_prediction=dur_prediction, chunk_frames=chunk_frames, context_frames=context_frames))
+
+    def batch_decode(self, codes, dur_prediction=True, max_batch_codes=4096):
+        """Synthesize many code sequences, batching similar lengths up to max_batch_codes padded codes."""
+        with torch.no_grad():
+            tts_inputs = [self._prepare(code) for code in codes]
+            audio_seqs = [None] * len(tts_inputs)
+            for batch_ids in length_batches([t.shape[0] for t in tts_inputs], max_batch_codes):
+                with metrics.stage('code2speech.vocoder', batch=len(batch_ids),
+                                   codes=sum(tts_inputs[i].shape[0] for i in batch_ids)) as stage:
+                    batch = self.hifigan.batch_forward([tts_inputs[i] for i in batch_ids],
+                                                       dur_prediction=dur_prediction)
+                    stage.update(samples=sum(audio_seq.shape[-1] for audio_seq in batch))
+                for i, audio_seq in zip(batch_ids, batch):
+                    audio_seqs[i] = audio_seq
+            return audio_seqs
+
+
+def load_backbone(hubert_model, device, quantize=False, state_dict=None):
+    if state_dict is None:
+        model = HubertModel.from_pretrained(hubert_model, local_files_only=offline())
+    else:
+        # weights loaded by another process, the model is built around them without a copy
+        with torch.device('meta'):
+            model = HubertModel(HubertConfig.from_pretrained(hubert_model, local_files_only=offline()))
+        model.load_state_dict(state_dict, assign=True)
+    model.eval()
+    if quantize:
+        # int8 weights for the transformer linears, activations are quantized on the fly; CPU kernels only
+        model.encoder = torch.ao.quantization.quantize_dynamic(model.encoder, {nn.Linear}, dtype=torch.qint8)
+    return model.to(device)
+
+
+def share_entry(key):
+    '''
+    Weights of the shared registry entry under key moved to shared memory, for load_shared in another
+    process, or None for entries every process loads itself: memory-mapped centroids, int8 backbones,
+    ONNX sessions and TorchScript vocoders.
+    '''
+    if key[0] == 'hubert' and key[2] == 'cpu' and key[3] == 'fp32':
+        module = shared_registry.get(key)
+    elif key[0] == 'hifigan' and not key[3]:
+        module = shared_registry.get(key).model
+    else:
+        return None
+    return {name: tensor.share_memory_() for name, tensor in module.state_dict().items()}
+
+
+def load_shared(key, state_dict):
+    '''The registry entry under key built around the weights share_entry returned in another process.'''
+    if key[0] == 'hubert':
+        return load_backbone(key[1], key[2], state_dict=state_dict)
+    return load_hifigan(key[1], json.loads(key[2]), state_dict=state_dict)
+
+
+def load_centroids(km_path, device):
+    if km_path.endswith('.npy'):
+        # memory-mapped, so every process on the host reads the same pages of the centroids
+        km_model = None
+        centroids = np.load(km_path, mmap_mode='r')
+    else:
+        km_model = joblib.load(km_path)
+        centroids = km_model.cluster_centers_
+    C_np = centroids.transpose()
+    Cnorm_np = (C_np ** 2).sum(0, keepdims=True)
+    return km_model, C_np, Cnorm_np, torch.from_numpy(C_np).to(device), torch.from_numpy(Cnorm_np).to(device)
+
+
+def feat_extract_output_lengths(config, lengths):
+    # frames the convolutional feature encoder produces from inputs of these lengths
+    for kernel, stride in zip(config.conv_kernel, config.conv_stride):
+        lengths = torch.div(lengths - kernel, stride, rounding_mode='floor') + 1
+    return lengths
+
+
+class SpeechCodes(dict):
+    '''
+    Outputs of an utterance as numpy arrays: code and merged_code, beam_code and beam_merged_code with beam
+    search, and distance [frames x clusters] and center_diff [frames x dim] with return_diff; a multi-head
+    encoder nests one SpeechCodes per head. tolist() gives the same outputs as Python lists.
+    '''
+
+    @classmethod
+    def concat(cls, chunks):
+        '''The outputs of consecutive chunks of an utterance, every array concatenated once.'''
+        result = cls()
+        for k, v in chunks[0].items():
+            if isinstance(v, dict):
+                result[k] = cls.concat([chunk[k] for chunk in chunks])
+            elif len(chunks) > 1:
+                result[k] = np.concatenate([chunk[k] for chunk in chunks])
+            else:
+                result[k] = v
+        return result
+
+    def tolist(self):
+        return {k: v.tolist() for k, v in self.items()}
+
 
 def dataloader_collate(batch):
     return torch.cat(batch, dim=0), [b.shape[0] for b in batch]
 
 
+def dataloader_worker_init(worker_id):
+    # decoding workers run side by side with the model, keep them from oversubscribing the cores
+    torch.set_num_threads(1)
+
+
+def truncate_hubert(model, num_layers):
+    '''
+    Return a view of a HubertModel that only runs the first `num_layers` transformer layers.
+    The view shares parameters with `model`, which is left untouched, and its `last_hidden_state`
+    equals `model(...).hidden_states[num_layers]`.
+    '''
+    layers = model.encoder.layers
+    if not 0 < num_layers <= len(layers):
+        raise ValueError(f"num_layers must be in [1, {len(layers)}], got {num_layers}")
+    truncated = copy.copy(model)
+    truncated._modules = copy.copy(model._modules)
+    encoder = copy.copy(model.encoder)
+    encoder._modules = copy.copy(model.encoder._modules)
+    encoder.layers = nn.ModuleList(list(layers)[:num_layers])
+    # stable layer norm encoders only normalize the output of the last layer
+    if model.config.do_stable_layer_norm and num_layers < len(layers):
+        encoder.layer_norm = nn.Identity()
+    truncated.encoder = encoder
+    return truncated
+
+
+class SpeechCodeStream(object):
+    '''
+    Incremental speech-to-unit session. feed() takes mono PCM blocks and returns the codes of frames
+    that later audio can no longer change: every frame is encoded with left_context_sec of past audio
+    and right_context_sec of lookahead, so latency is about step_sec + right_context_sec.
+    flush() encodes the remaining frames and resets the session.
+    '''
+
+    def __init__(self, speech2code, sampling_rate=None, step_sec=0.5, left_context_sec=2.0, right_context_sec=0.5):
+        self.sc = speech2code
+        config = self.sc.config
+        self.hop = math.prod(config.conv_stride)
+        # samples seen by one frame of the convolutional feature encoder
+        self.receptive_field = 1 + sum((kernel - 1) * math.prod(config.conv_stride[:i])
+                                       for i, kernel in enumerate(config.conv_kernel))
+        frame_rate = self.sc.sampling_rate / self.hop
+        self.step_frames = max(1, round(step_sec * frame_rate))
+        self.left_frames = round(left_context_sec * frame_rate)
+        self.right_frames = round(right_context_sec * frame_rate)
+        self.resampler = None
+        if sampling_rate and sampling_rate != self.sc.sampling_rate:
+            self.resampler = StreamResampler(sampling_rate, self.sc.sampling_rate)
+        self.reset()
+
+    def reset(self):
+        self.buffer = torch.zeros(0)
+        self.buffer_start = 0
+        self.num_samples = 0
+        self.emitted = 0
+        if self.resampler is not None:
+            self.resampler.reset()
+
+    def _num_frames(self, num_samples):
+        return max(0, (num_samples - self.receptive_field) // self.hop + 1)
+
+    def _append(self, pcm):
+        self.buffer = torch.cat([self.buffer, pcm])
+        self.num_samples += pcm.shape[-1]
+
+    def _encode(self, end_frame):
+        start_frame = max(0, self.emitted - self.left_frames)
+        window = self.buffer[start_frame * self.hop - self.buffer_start:]
+        with torch.no_grad():
+            hidden = self.sc._forward(window[None, :].to(self.sc.device))[0]
+        codes = self.sc._process_feature(hidden[self.emitted - start_frame:end_frame - start_frame])['code'].tolist()
+        self.emitted = end_frame
+        keep = max(0, end_frame - self.left_frames) * self.hop
+        self.buffer = self.buffer[keep - self.buffer_start:]
+        self.buffer_start = keep
+        return codes
+
+    def feed(self, pcm):
+        pcm = torch.as_tensor(pcm, dtype=torch.float32)
+        if self.resampler is not None:
+            pcm = self.resampler(pcm)
+        self._append(pcm)
+        end_frame = self._num_frames(self.num_samples) - self.right_frames
+        if end_frame - self.emitted < self.step_frames:
+            return []
+        return self._encode(end_frame)
+
+    def flush(self):
+        if self.resampler is not None:
+            self._append(self.resampler.flush())
+        end_frame = self._num_frames(self.num_samples)
+        codes = self._encode(end_frame) if end_frame > self.emitted else []
+        self.reset()
+        return codes
+
+
 class _Speech2Code(object):
+    backend = 'torch'
+
     def __init__(self, hubert_model, km_path, km_layer,
                  sampling_rate=16000,
                  chunk_sec=10,
                  worker=0,
                  return_diff=False,
-                 batch=None):
-        self.processor = Wav2Vec2FeatureExtractor.from_pretrained(hubert_model)
-        self.model = HubertModel.from_pretrained(hubert_model)
-        self.model.eval()
+                 batch=None,
+                 truncate=True,
+                 quantize=False):
+        self.hubert_model = hubert_model
+        self.km_path = km_path
+        self.km_layer = km_layer
+        # only run the backbone up to the k-means layer
+        self.truncate = truncate
+        # int8 dynamic quantization of the backbone and the centroid matmul, which only runs on CPU
+        self.quantize = quantize
+        self.device = 'cuda' if torch.cuda.is_available() and self.backend == 'torch' and not quantize else 'cpu'
+        # weights are loaded once per process and shared read-only between tokenizers
+        keys = [('feature_extractor', hubert_model), ('kmeans', km_path, self.device)]
+        self.processor = shared_registry.acquire(keys[0], lambda: Wav2Vec2FeatureExtractor.from_pretrained(
+            hubert_model, local_files_only=offline()))
+        self.km_model, self.C_np, self.Cnorm_np, self.C, self.Cnorm = shared_registry.acquire(
+            keys[1], lambda: load_centroids(km_path, self.device))
+        self.C_q = quantize_centroids(self.C) if quantize else None
+        keys += self._load_backbone()
+        self.registry_keys = keys
+        self._release = weakref.finalize(self, shared_registry.release, *keys)
         self.sampling_rate = sampling_rate
         self.chunk_length = sampling_rate * chunk_sec
-        self.km_model = joblib.load(km_path)
-        self.km_layer = km_layer
-        self.C_np = self.km_model.cluster_centers_.transpose()
-        self.Cnorm_np = (self.C_np ** 2).sum(0, keepdims=True)
-        self.worker = worker
+        # processes that decode, resample and normalize files ahead of the model
+        self.worker = min(worker, os.cpu_count() or 1)
         self.return_diff = return_diff
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        self.C = torch.from_numpy(self.C_np)
-        self.Cnorm = torch.from_numpy(self.Cnorm_np)
-        if torch.cuda.is_available():
-            self.C = self.C.cuda()
-            self.Cnorm = self.Cnorm.cuda()
-            self.model = self.model.cuda()
         self.max_batch = batch if batch else self.get_max_batch()
+        # padded samples per forward pass; batches are packed by length against this budget
+        self.batch_samples = self.max_batch * self.chunk_length
+
+    def close(self):
+        self._release()
+
+    def _load_backbone(self):
+        '''Set self.model and self.config, returning the shared registry keys acquired for them.'''
+        key = ('hubert', self.hubert_model, self.device, 'int8' if self.quantize else 'fp32')
+        self.model = shared_registry.acquire(key, lambda: load_backbone(self.hubert_model, self.device,
+                                                                        self.quantize))
+        self.config = self.model.config
+        if self.truncate:
+            self.model = truncate_hubert(self.model, self.km_layer)
+        return [key]
+
+    def _autotune_key(self):
+        layers = self.km_layer if self.truncate else 'all'
+        key = f"{self.hubert_model}|layers-{layers}|chunk-{self.chunk_length}"
+        if self.quantize:
+            key += "|int8"
+        if self.backend != 'torch':
+            key += f"|{self.backend}"
+        return key
 
     def get_max_batch(self):
-        batch = 1
-        with torch.no_grad():
-            try:
-                while True:
-                    self.model(torch.rand([batch, self.chunk_length]).cuda())
-                    batch += 2
-                    gc.collect()
-                    torch.cuda.empty_cache()
-            except:
-                pass
-        batch = max(int(batch * 0.95), 1)
-        return batch
+        return autotune_batch(self._forward, self.chunk_length, self.device, self._autotune_key())
+
+    def _forward(self, batch, attention_mask=None):
+        with metrics.stage('speech2code.forward', batch=batch.shape[0], samples=batch.numel()):
+            if self.truncate:
+                return self.model(batch, attention_mask=attention_mask).last_hidden_state.detach()
+            return self.model(batch, attention_mask=attention_mask,
+                              output_hidden_states=True).hidden_states[self.km_layer].detach()
+
+    def _input_batches(self, filepaths, input_values):
+        '''Yield (input indices, audios), loading inputs in groups of similar length.'''
+        if len(filepaths) > 0:
+            dataset = SpeechDataset(filepaths, input_values, self.processor, self.sampling_rate)
+            batches = length_batches([dataset.num_samples(i) for i in range(len(dataset))], self.batch_samples)
+            # a worker only pays for its startup when batches can load while the model runs
+            worker = min(self.worker, len(batches)) if len(batches) > 1 else 0
+            dataloader = DataLoader(dataset=dataset, batch_sampler=batches,
+                                    num_workers=worker,
+                                    prefetch_factor=2 if worker > 0 else None,
+                                    worker_init_fn=dataloader_worker_init,
+                                    pin_memory=self.device == 'cuda',
+                                    collate_fn=dataloader_collate)
+            for indices, (data_batch, size) in zip(batches, dataloader):
+                yield indices, torch.split(data_batch, size)
+        else:
+            for indices in length_batches([iv.shape[-1] for iv in input_values], self.batch_samples):
+                yield indices, [input_values[i] for i in indices]
+
+    def stream(self, sampling_rate=None, step_sec=0.5, left_context_sec=2.0, right_context_sec=0.5):
+        return SpeechCodeStream(self, sampling_rate=sampling_rate, step_sec=step_sec,
+                                left_context_sec=left_context_sec, right_context_sec=right_context_sec)
+
+    def _file_blocks(self, filepath):
+        '''Yield a file as mono blocks at the encoder sampling rate, one chunk_length of input at a time.'''
+        with soundfile.SoundFile(filepath) as f:
+            resampler = None
+            if f.samplerate != self.sampling_rate:
+                resampler = StreamResampler(f.samplerate, self.sampling_rate)
+            for block in f.blocks(blocksize=self.chunk_length, dtype='float32', always_2d=True):
+                speech = torch.from_numpy(block).mean(-1)
+                yield resampler(speech) if resampler is not None else speech
+            if resampler is not None:
+                yield resampler.flush()
+
+    def iter_file(self, filepath, feat_norm=False, beamsearch=False, top_k=5, beamsize=5):
+        '''
+        Encode a file of any duration window by window, yielding one result per chunk_length window.
+        The file is read in blocks and at most max_batch windows are held at a time, so memory does not
+        grow with the duration. Windows follow the chunking of __call__, which gives the same codes.
+        '''
+        mean, std = 0.0, 1.0
+        if getattr(self.processor, 'do_normalize', False):
+            # the feature extractor normalizes over the whole signal, take its statistics in a first pass
+            total, total_sq, count = 0.0, 0.0, 0
+            for speech in self._file_blocks(filepath):
+                speech = speech.double()
+                total += speech.sum().item()
+                total_sq += speech.pow(2).sum().item()
+                count += speech.shape[-1]
+            mean = total / max(count, 1)
+            std = math.sqrt(max(total_sq / max(count, 1) - mean ** 2, 0.0) + 1e-7)
+
+        def encode(windows):
+            results = self(input_values=windows, feat_norm=feat_norm, beamsearch=beamsearch,
+                           top_k=top_k, beamsize=beamsize)
+            return [results] if len(windows) == 1 else results
+
+        pending = torch.zeros(0)
+        windows = []
+        for speech in self._file_blocks(filepath):
+            pending = torch.cat([pending, (speech - mean) / std])
+            # a window is final once a tail too long to be merged into it follows
+            while pending.shape[-1] >= self.chunk_length + self.sampling_rate:
+                windows.append(pending[:self.chunk_length])
+                pending = pending[self.chunk_length:]
+                if len(windows) == self.max_batch:
+                    yield from encode(windows)
+                    windows = []
+        if pending.shape[-1] > 0:
+            windows.append(pending)
+        if windows:
+            yield from encode(windows)
 
     def _process_feature(self, k, top_k=100, feat_norm=False, beamsearch=False, beamsize=5):
         feature = torch.cat(k, dim=0) if isinstance(k, list) else k
-        if feat_norm:
-            m = nn.BatchNorm1d(feature.shape[-1], affine=False).to(self.device)
-            feature = m(feature)
-        dist = torch.sqrt(
-            feature.pow(2).sum(1, keepdim=True)
-            - 2 * torch.matmul(feature, self.C)
-            + self.Cnorm
-        )
-        min_dist = torch.topk(dist.detach().cpu(), top_k, dim=-1, largest=False)
-        pred_ind_array = min_dist.indices.cpu().numpy()
-        pred_values_array = min_dist.values.cpu().numpy()
-        code_output = min_dist.indices.T.cpu().numpy()[0]
-        return_dict = {
-            'code': list(code_output),
-            'merged_code': [k for k, _ in groupby(code_output)]
-        }
+        return self._assign(feature, self.C_q if self.quantize else self.C, self.Cnorm, self.C_np, top_k=top_k,
+                            feat_norm=feat_norm, beamsearch=beamsearch, beamsize=beamsize)
+
+    def _assign(self, feature, C, Cnorm, C_np, top_k=100, feat_norm=False, beamsearch=False, beamsize=5):
+        with metrics.stage('speech2code.assign', frames=feature.shape[0]):
+            if feat_norm:
+                m = nn.BatchNorm1d(feature.shape[-1], affine=False).to(self.device)
+                feature = m(feature)
+            # argmin is enough unless beam search needs the top_k candidates
+            min_ind, min_dist = nearest_centroids(feature, C, Cnorm, top_k=top_k if beamsearch else 1)
+        return_dict = self._codes(min_ind.numpy(), min_dist.numpy(), beamsearch=beamsearch, beamsize=beamsize)
         if self.return_diff:
-            return_dict.update({
-                'distance': list(dist.detach().cpu().numpy()),
-                'center_diff': list((feature.cpu() - torch.index_select(torch.tensor(self.C_np.transpose()).cpu(), 0,
-                                                                        min_dist.indices[:, 0].cpu())).numpy()),
-            })
+            with metrics.stage('speech2code.distance', frames=feature.shape[0]):
+                dist = torch.cat([squared_distances(block, C, Cnorm).clamp_(min=0).sqrt_().cpu()
+                                  for block in torch.split(feature, 4096)])
+                # C_np.T holds the centroids as rows, so their residuals need neither a copy nor a transpose
+                return_dict.update({
+                    'distance': dist.numpy(),
+                    'center_diff': feature.cpu().numpy() - C_np.T[return_dict['code']],
+                })
+        return return_dict
+
+    def _codes(self, pred_ind_array, pred_values_array, beamsearch=False, beamsize=5):
+        '''Codes from the [frames x top_k] nearest centroids and their distances, closest first.'''
+        code_output = np.ascontiguousarray(pred_ind_array[:, 0])
+        return_dict = SpeechCodes(code=code_output, merged_code=run_length(code_output)[0])
         if beamsearch:
-            sequences = [[[], 1.0]]
-            self.var_list = []
-            for i_row, v_row in zip(pred_ind_array, pred_values_array):
-                all_candidates = list()
-                for seq in sequences:
-                    tokens, score = seq
-                    self.var_list.append(np.var(v_row))
-                    for k, v in zip(i_row, v_row):
-                        norm_len_rate = (len(code_output) / len([k for k, _ in groupby(tokens + [k])]))
-                        norm_dist_rate = np.var(v_row) / v
-                        candidate = [tokens + [k], score + norm_len_rate * norm_dist_rate]
-                        all_candidates.append(candidate)
-                ordered = sorted(all_candidates, key=lambda tup: tup[1], reverse=True)
-                sequences = ordered[:beamsize]
-            code_output = sequences[0][0]
-            return_dict['beam_code'] = code_output
-            return_dict['beam_merged_code'] = [k for k, _ in groupby(code_output)]
+            with metrics.stage('speech2code.beam_search', frames=len(pred_ind_array)):
+                code_output, self.var_list = beam_search_units(pred_ind_array, pred_values_array, beamsize=beamsize)
+                return_dict['beam_code'] = code_output
+                return_dict['beam_merged_code'] = run_length(code_output)[0]
         return return_dict
 
     def __call__(self, filepaths=None, input_values=None, feat_norm=False, beamsearch=False, top_k=5, beamsize=5):
@@ -170,34 +517,23 @@ class _Speech2Code(object):
             if input_values is None:
                 input_values = []
 
+            # a tensor is one input, not a list of samples
+            if isinstance(input_values, torch.Tensor):
+                input_values = [input_values]
+
             if len(filepaths) == 0 and len(input_values) == 0:
                 raise ValueError("Both 'filepaths' and 'input_values' are empty. Provide at least one of them.")
 
             is_single_input = (len(filepaths) == 1 and len(input_values) == 0) or (
                     len(filepaths) == 0 and len(input_values) == 1)
 
-            if isinstance(input_values, torch.Tensor):
-                input_values = [input_values]
-
-            if len(filepaths) > 0:
-                dataset = SpeechDataset(filepaths, input_values, self.processor, self.sampling_rate)
-                dataloader = DataLoader(dataset=dataset, batch_size=self.max_batch,
-                                        shuffle=False,
-                                        num_workers=0,
-                                        collate_fn=dataloader_collate)
-                process_data_batches = iter(dataloader)
-            else:
-                def process_input_values():
-                    for iv in input_values:
-                        yield iv, [iv.shape[0]]
-
-                process_data_batches = process_input_values()
-
-            return_list = []
-            for data_batch, size in process_data_batches:
+            return_list = [None] * (len(filepaths) + len(input_values))
+            # time spent waiting for inputs, i.e. loading not hidden behind the model by the DataLoader
+            for indices, audios in metrics.iterate('speech2code.input',
+                                                   self._input_batches(filepaths, input_values)):
                 batch_data = []
                 batch_map_audio = []
-                for b_id, audio in enumerate(torch.split(data_batch, size)):
+                for b_id, audio in zip(indices, audios):
                     split_chunks = list(torch.split(audio, self.chunk_length, dim=-1))
 
                     # Check if the last chunk is smaller than the sampling_rate
@@ -207,37 +543,217 @@ class _Speech2Code(object):
                         split_chunks = split_chunks[:concat_index + 1]
 
                     # Iterate through chunks and append them to batch_data and batch_map_audio
-                    for chunk in split_chunks:
+                    for c_id, chunk in enumerate(split_chunks):
                         batch_data.append(chunk)
-                        batch_map_audio.append(b_id)
-
-                code_result = defaultdict(list)
-                for bd, bm in zip(chunks(batch_data, self.max_batch), chunks(batch_map_audio, self.max_batch)):
-                    batch, lengths, masks = collate_fn_pad(bd, self.device)
-                    masks_ratio = lengths / torch.max(lengths)
-                    hidden = self.model(batch,
-                                        output_hidden_states=True).hidden_states[self.km_layer].detach()
-                    mask_len = (hidden.shape[1] * masks_ratio).int()
-                    for a, h, ml in zip(bm, hidden, mask_len):
-                        code_result[a].append(h[:ml, :])
+                        batch_map_audio.append((b_id, c_id))
+
+                # chunks of similar length share a forward pass, so little of it is spent on padding; the
+                # GroupNorm of group-norm feature encoders also averages over padding, which the attention
+                # mask does not undo, so there only chunks of equal length are batched
+                code_result = defaultdict(dict)
+                for batch_ids in length_batches([c.shape[-1] for c in batch_data], self.batch_samples,
+                                                exact=self.config.feat_extract_norm == 'group'):
+                    with metrics.stage('speech2code.collate', batch=len(batch_ids)):
+                        batch, lengths, masks = collate_fn_pad([batch_data[i] for i in batch_ids], self.device)
+                    padded = bool((lengths < batch.shape[1]).any())
+                    hidden = self._forward(batch, masks.long() if padded else None)
+                    frame_lengths = feat_extract_output_lengths(self.config, lengths)
+                    for i, h, fl in zip(batch_ids, hidden, frame_lengths):
+                        b_id, c_id = batch_map_audio[i]
+                        code_result[b_id][c_id] = h[:fl, :]
 
                 for k, v in code_result.items():
-                    result = {}
-                    for d in thread_map(
+                    v = [v[c_id] for c_id in sorted(v)]
+                    with metrics.stage('speech2code.postprocess', frames=sum(h.shape[0] for h in v)):
+                        return_list[k] = SpeechCodes.concat(thread_map(
                             partial(self._process_feature,
                                     top_k=top_k,
                                     beamsearch=beamsearch,
                                     beamsize=beamsize,
                                     feat_norm=feat_norm), v,
-                            leave=False, disable=True):
-                        for k2, v2 in d.items():
-                            if k2 in result:
-                                result[k2].extend(v2)
-                            else:
-                                result[k2] = v2
-                    return_list.append(result)
+                            leave=False, disable=True))
 
         if is_single_input:
             return return_list[0]
         else:
             return return_list
+
+
+class _MultiSpeech2Code(_Speech2Code):
+    """
+    Speech-to-unit encoder with several k-means heads, heads maps a name to (km_path, km_layer).
+    The backbone runs once per batch up to the deepest head layer and every head quantizes its own layer,
+    results hold one entry per head name.
+    """
+
+    def __init__(self, hubert_model, heads, **kwargs):
+        deepest = max(heads, key=lambda name: heads[name][1])
+        super().__init__(hubert_model, *heads[deepest], **kwargs)
+        keys = [('kmeans', km_path, self.device) for km_path, _ in heads.values()]
+        self.heads = []
+        for name, (km_path, km_layer) in heads.items():
+            _, C_np, _, C, Cnorm = shared_registry.acquire(('kmeans', km_path, self.device),
+                                                          lambda: load_centroids(km_path, self.device))
+            self.heads.append((name, km_layer, quantize_centroids(C) if self.quantize else C, Cnorm, C_np))
+        self._release_heads = weakref.finalize(self, shared_registry.release, *keys)
+
+    def close(self):
+        self._release_heads()
+        super().close()
+
+    def _forward(self, batch, attention_mask=None):
+        with metrics.stage('speech2code.forward', batch=batch.shape[0], samples=batch.numel()):
+            hidden_states = self.model(batch, attention_mask=attention_mask,
+                                       output_hidden_states=True).hidden_states
+            # B x T x heads x dim
+            return torch.stack([hidden_states[head[1]] for head in self.heads], dim=2).detach()
+
+    def _process_feature(self, k, top_k=100, feat_norm=False, beamsearch=False, beamsize=5):
+        feature = torch.cat(k, dim=0) if isinstance(k, list) else k
+        return {name: self._assign(feature[:, i], C, Cnorm, C_np, top_k=top_k, feat_norm=feat_norm,
+                                   beamsearch=beamsearch, beamsize=beamsize)
+                for i, (name, _, C, Cnorm, C_np) in enumerate(self.heads)}
+
+
+class _EncoderGraph(nn.Module):
+    '''Truncated backbone followed by the top_k nearest centroids of every frame, exported as one graph.'''
+
+    def __init__(self, model, C, Cnorm, top_k):
+        super().__init__()
+        self.model = model
+        self.register_buffer('C', C.float().cpu().clone())
+        self.register_buffer('Cnorm', Cnorm.float().cpu().clone())
+        self.top_k = min(top_k, C.shape[1])
+
+    def forward(self, input_values, attention_mask):
+        hidden = self.model(input_values, attention_mask=attention_mask).last_hidden_state
+        dist = hidden.pow(2).sum(-1, keepdim=True) - 2 * torch.matmul(hidden, self.C) + self.Cnorm
+        values, indices = torch.topk(dist, self.top_k, dim=-1, largest=False)
+        return indices, values.clamp(min=0).sqrt()
+
+
+def _import_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("Please install onnxruntime: pip install onnx onnxruntime")
+    return onnxruntime
+
+
+def export_onnx_encoder(hubert_model, km_path, km_layer, top_k=5):
+    '''
+    Path of the ONNX graph mapping input_values and attention_mask [batch x samples] to the indices and
+    distances [batch x frames x top_k] of the nearest centroids, exported once and kept as an artifact.
+    Batch and time axes are dynamic.
+    '''
+    stat = os.stat(km_path)
+    spec = json.dumps([hubert_model, os.path.abspath(km_path), stat.st_size, stat.st_mtime, km_layer, top_k,
+                       torch.__version__])
+    name = f"onnx/{hashlib.sha256(spec.encode()).hexdigest()[:16]}.onnx"
+
+    def export(tmp_path):
+        _, _, _, C, Cnorm = load_centroids(km_path, 'cpu')
+        graph = _EncoderGraph(truncate_hubert(load_backbone(hubert_model, 'cpu'), km_layer), C, Cnorm, top_k)
+        example = torch.randn(2, 16000)
+        dynamic_axes = {'input_values': {0: 'batch', 1: 'samples'}, 'attention_mask': {0: 'batch', 1: 'samples'},
+                        'indices': {0: 'batch', 1: 'frames'}, 'distances': {0: 'batch', 1: 'frames'}}
+        with torch.no_grad(), warnings.catch_warnings():
+            # tracer warnings about shape-dependent branches, which do not depend on the input length here
+            warnings.simplefilter('ignore')
+            torch.onnx.export(graph.eval(), (example, torch.ones(example.shape, dtype=torch.long)), tmp_path,
+                              input_names=['input_values', 'attention_mask'],
+                              output_names=['indices', 'distances'],
+                              dynamic_axes=dynamic_axes, opset_version=17, dynamo=False)
+
+    return derive(name, export)
+
+
+def load_onnx_session(path):
+    return _import_onnxruntime().InferenceSession(path, providers=['CPUExecutionProvider'])
+
+
+class _OnnxSpeech2Code(_Speech2Code):
+    """
+    Speech-to-unit encoder running the truncated backbone and the nearest-centroid search as one ONNX Runtime
+    graph on CPU, with the same codes as the torch backend. top_k is fixed when the graph is exported, and
+    feat_norm and return_diff, which need the hidden states, are not available.
+    """
+    backend = 'onnx'
+
+    def __init__(self, hubert_model, km_path, km_layer, top_k=5, **kwargs):
+        if kwargs.get('quantize') or kwargs.get('return_diff'):
+            raise ValueError("the onnx backend supports neither quantize nor return_diff")
+        self.top_k = top_k
+        super().__init__(hubert_model, km_path, km_layer, **kwargs)
+
+    def _load_backbone(self):
+        _import_onnxruntime()
+        path = export_onnx_encoder(self.hubert_model, self.km_path, self.km_layer, self.top_k)
+        key = ('onnx', path)
+        self.session = shared_registry.acquire(key, lambda: load_onnx_session(path))
+        self.config = HubertConfig.from_pretrained(self.hubert_model, local_files_only=offline())
+        self.model = None
+        return [key]
+
+    def _forward(self, batch, attention_mask=None):
+        # [batch x frames x top_k x 2], the distance and index of each nearest centroid, closest first
+        with metrics.stage('speech2code.forward', batch=batch.shape[0], samples=batch.numel()):
+            if attention_mask is None:
+                attention_mask = torch.ones(batch.shape, dtype=torch.long)
+            indices, distances = self.session.run(None, {'input_values': batch.float().cpu().numpy(),
+                                                         'attention_mask': attention_mask.long().cpu().numpy()})
+            distances = torch.from_numpy(distances)
+            return torch.stack([distances, torch.from_numpy(indices).to(distances.dtype)], dim=-1)
+
+    def _process_feature(self, k, top_k=100, feat_norm=False, beamsearch=False, beamsize=5):
+        if feat_norm:
+            raise ValueError("feat_norm needs the hidden states, which the onnx backend does not compute")
+        output = torch.cat(k, dim=0) if isinstance(k, list) else k
+        top_k = min(top_k, self.Cnorm.shape[-1]) if beamsearch else 1
+        if top_k > output.shape[1]:
+            raise ValueError(f"the onnx graph keeps {output.shape[1]} candidates, pass top_k={top_k} when "
+                             f"building the encoder")
+        with metrics.stage('speech2code.assign', frames=output.shape[0]):
+            indices = output[:, :top_k, 1].long().numpy()
+            distances = output[:, :top_k, 0].numpy()
+        return self._codes(indices, distances, beamsearch=beamsearch, beamsize=beamsize)
+
+
+# speech-to-unit encoders by backend name
+BACKENDS = {
+    'torch': _Speech2Code,
+    'onnx': _OnnxSpeech2Code,
+}
+
+
+def load_speech2code(hubert_model, km_path, km_layer, backend='torch', **kwargs):
+    if backend not in BACKENDS:
+        raise ValueError(f"backend {backend} not found in {BACKENDS.keys()}")
+    return BACKENDS[backend](hubert_model, km_path, km_layer, **kwargs)
+
+
+def quantization_report(hubert_model, km_path, km_layer, filepaths=None, input_values=None, **kwargs):
+    '''
+    Encode the same inputs with the fp32 and the int8 encoder and report the fraction of frames whose code
+    agrees, overall and for the worst utterance, with the time each encoder took. kwargs go to _Speech2Code.
+    '''
+    report = {}
+    codes = {}
+    for name, quantize in [('fp32', False), ('int8', True)]:
+        sc = _Speech2Code(hubert_model, km_path, km_layer, quantize=quantize, **kwargs)
+        # warm up allocator and kernels on the first input only
+        sc(filepaths=filepaths[:1] if filepaths else None, input_values=None if filepaths else input_values[:1])
+        start = time.perf_counter()
+        results = sc(filepaths=filepaths, input_values=input_values)
+        report[f"{name}_sec"] = time.perf_counter() - start
+        codes[name] = [np.asarray(r['code']) for r in (results if isinstance(results, list) else [results])]
+        sc.close()
+    agreements = [(a == b).sum() for a, b in zip(codes['fp32'], codes['int8'])]
+    frames = [len(a) for a in codes['fp32']]
+    report.update({
+        'frames': int(sum(frames)),
+        'code_agreement': float(sum(agreements) / max(sum(frames), 1)),
+        'min_utterance_agreement': float(min(a / max(f, 1) for a, f in zip(agreements, frames))),
+        'speedup': report['fp32_sec'] / report['int8_sec'],
+    })
+    return report
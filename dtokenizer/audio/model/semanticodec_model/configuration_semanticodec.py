@@ -1,16 +1,19 @@
 import math
-import os
-import nlp2
-import torch
+
 from dtokenizer.interface import BaseTokenizer
+from dtokenizer.metrics import metrics
+
+
+def _import_semanticodec():
+    try:
+        import semanticodec
+        import semanticodec.main
+        import semanticodec.utils
+    except ImportError:
+        raise ImportError(
+            "Please install semanticodec: pip install git+https://github.com/haoheliu/SemantiCodec-inference.git")
+    return semanticodec
 
-try:
-    from semanticodec import SemantiCodec
-    from semanticodec.main import AUDIOMAE_PATCH_DURATION, SAMPLE_RATE, SEGMENT_DURATION, MEL_TARGET_LENGTH
-    from semanticodec.utils import extract_kaldi_fbank_feature
-except ImportError:
-    raise ImportError(
-        "Please install semanticodec: pip install git+https://github.com/haoheliu/SemantiCodec-inference.git")
 
 CONFIG = {
     "semanticodec_25_035": (25, 32768),
@@ -24,12 +27,26 @@ class SemanticodecTokenizer(BaseTokenizer):
     def __init__(self, config):
         self.sampling_rate = 16000
         if config in CONFIG:
-            token_rate, semantic_vocab_size = CONFIG[config]
-            self.model = SemantiCodec(token_rate, semantic_vocab_size)
+            self.config = config
+            self._model = None
         else:
             raise ValueError(f"config {config} not found in {CONFIG.keys()}")
 
+    @property
+    def model(self):
+        # semanticodec and its weights are loaded on the first encode/decode
+        if self._model is None:
+            token_rate, semantic_vocab_size = CONFIG[self.config]
+            self._model = _import_semanticodec().SemantiCodec(token_rate, semantic_vocab_size)
+        return self._model
+
     def encode(self, speech, sampling_rate):
+        import torch
+        semanticodec = _import_semanticodec()
+        AUDIOMAE_PATCH_DURATION = semanticodec.main.AUDIOMAE_PATCH_DURATION
+        SEGMENT_DURATION = semanticodec.main.SEGMENT_DURATION
+        MEL_TARGET_LENGTH = semanticodec.main.MEL_TARGET_LENGTH
+        extract_kaldi_fbank_feature = semanticodec.utils.extract_kaldi_fbank_feature
         if speech.shape[0] > 1:
             speech = speech[0:1]
         original_duration = speech.shape[1] / sampling_rate
@@ -61,12 +78,15 @@ class SemanticodecTokenizer(BaseTokenizer):
         mel = extract_kaldi_fbank_feature(
             speech, sampling_rate, target_length=mel_target_length
         )["ta_kaldi_fbank"].unsqueeze(0)
-        tokens = self.model.encoder(mel.to(self.device))
+        with metrics.stage('semanticodec.encode', samples=speech.shape[1]):
+            tokens = self.model.encoder(mel.to(self.device))
         tokens = tokens[:, : math.ceil(target_token_len), :]
         return tokens, None
 
     def encode_file(self, input_file):
-        return self.model.encode(input_file), None
+        with metrics.stage('semanticodec.encode_file'):
+            return self.model.encode(input_file), None
 
     def decode(self, code):
-        return self.model.decode(code)
+        with metrics.stage('semanticodec.decode'):
+            return self.model.decode(code)
@@ -0,0 +1,49 @@
+import threading
+
+
+class SharedRegistry(object):
+    '''
+    Process-wide store of read-only objects (backbones, feature extractors, k-means centroids, vocoders).
+    acquire() builds an object on first use and hands the same instance to every later caller; each
+    acquire() must be paired with a release(), and the object is dropped once nobody holds it.
+    '''
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def acquire(self, key, factory):
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = [factory(), 0]
+            entry = self._entries[key]
+            entry[1] += 1
+            return entry[0]
+
+    def get(self, key):
+        '''The object held under key, without acquiring it.'''
+        with self._lock:
+            return self._entries[key][0]
+
+    def release(self, *keys):
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self._entries[key]
+
+    def refcount(self, key):
+        with self._lock:
+            return self._entries[key][1] if key in self._entries else 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+shared_registry = SharedRegistry()
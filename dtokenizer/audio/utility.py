@@ -1,4 +1,8 @@
+import math
+
+import numpy as np
 import torch
+import torchaudio
 
 
 def collate_fn_pad(batch, device):
@@ -13,7 +17,7 @@ def collate_fn_pad(batch, device):
     batch = [torch.Tensor(t).to(device) for t in batch]
     batch = torch.nn.utils.rnn.pad_sequence(batch, batch_first=True, padding_value=0)
     ## compute mask
-    mask = (batch != 0).to(device)
+    mask = torch.arange(batch.shape[1], device=device)[None, :] < lengths[:, None]
     return batch, lengths, mask
 
 
@@ -21,3 +25,145 @@ def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for i in range(0, len(l), n):
         yield l[i:i + n]
+
+
+def length_batches(lengths, budget, exact=False):
+    """
+    Group item indices into batches whose padded size (items x longest item) stays within budget.
+    Items are sorted longest first so each batch holds similar lengths; an item longer than the
+    budget gets a batch of its own. With exact, only items of equal length share a batch.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches = []
+    for i in order:
+        if batches and (len(batches[-1]) + 1) * lengths[batches[-1][0]] <= budget and (
+                not exact or lengths[i] == lengths[batches[-1][0]]):
+            batches[-1].append(i)
+        else:
+            batches.append([i])
+    return batches
+
+
+def quantize_centroids(centroids):
+    """Int8 dynamic-quantized Linear computing feature @ centroids, usable as centroids in squared_distances."""
+    linear = torch.nn.Linear(centroids.shape[0], centroids.shape[1], bias=False)
+    linear.weight.data = centroids.t().float().cpu().contiguous()
+    return torch.ao.quantization.quantize_dynamic(torch.nn.Sequential(linear), {torch.nn.Linear},
+                                                  dtype=torch.qint8)[0]
+
+
+def squared_distances(feature, centroids, centroid_norm):
+    """
+    Squared euclidean distances [frames x clusters] between rows of feature and columns of centroids,
+    or the centroids held by a module from quantize_centroids.
+    """
+    projection = centroids(feature) if isinstance(centroids, torch.nn.Module) else torch.matmul(feature, centroids)
+    return feature.pow(2).sum(1, keepdim=True) - 2 * projection + centroid_norm
+
+
+def nearest_centroids(feature, centroids, centroid_norm, top_k=1, block_size=4096):
+    """
+    Find the top_k nearest centroids of every frame, block_size frames at a time, so the
+    [frames x clusters] distance matrix is never held in full and never copied to the host.
+    Returns CPU tensors (indices, distances) of shape [frames x top_k], closest first.
+    """
+    top_k = min(top_k, centroid_norm.shape[-1])
+    indices, distances = [], []
+    for block in torch.split(feature, block_size):
+        dist = squared_distances(block, centroids, centroid_norm)
+        if top_k == 1:
+            values, index = torch.min(dist, dim=-1, keepdim=True)
+        else:
+            values, index = torch.topk(dist, top_k, dim=-1, largest=False)
+        # sqrt is monotonic, so it is only taken on the selected distances
+        indices.append(index.cpu())
+        distances.append(values.clamp_(min=0).sqrt_().cpu())
+    return torch.cat(indices), torch.cat(distances)
+
+
+def beam_search_units(indices, distances, beamsize=5):
+    """
+    Beam search over the per-frame top_k centroid candidates (indices and distances, [frames x top_k]).
+    A candidate scores (frames / runs) * (var(distances of the frame) / distance), where runs is the number
+    of runs of identical units in the sequence, so every beam only carries its score, last unit and run count.
+    Returns the best unit sequence and the per-frame distance variances.
+    """
+    indices = np.asarray(indices)
+    distances = np.asarray(distances)
+    num_frames, top_k = indices.shape
+    frame_var = np.var(distances, axis=1)
+    scores = np.ones(1)
+    last = np.full(1, -1, dtype=indices.dtype)
+    runs = np.zeros(1, dtype=np.int64)
+    parents, tokens = [], []
+    for row_ind, row_dist, var in zip(indices, distances, frame_var):
+        # candidates are laid out beam-major, the order the beams were ranked in
+        cand_runs = runs[:, None] + (last[:, None] != row_ind[None, :])
+        cand_scores = scores[:, None] + (num_frames / cand_runs) * (var / row_dist)[None, :]
+        best = np.argsort(-cand_scores.ravel(), kind='stable')[:beamsize]
+        beam, k = np.divmod(best, top_k)
+        scores = cand_scores[beam, k]
+        runs = cand_runs[beam, k]
+        last = row_ind[k]
+        parents.append(beam)
+        tokens.append(last)
+    sequence = np.empty(num_frames, dtype=indices.dtype)
+    beam = 0
+    for t in range(num_frames - 1, -1, -1):
+        sequence[t] = tokens[t][beam]
+        beam = parents[t][beam]
+    return sequence, frame_var
+
+
+class StreamResampler(object):
+    """
+    Resample a signal that arrives in blocks. Output matches resampling the whole signal at once:
+    each block is resampled together with enough neighbouring input for the sinc kernel, which
+    delays the output by that right context until flush().
+    """
+
+    def __init__(self, orig_freq, new_freq, lowpass_filter_width=6, rolloff=0.99):
+        gcd = math.gcd(orig_freq, new_freq)
+        self.orig_freq = orig_freq
+        self.new_freq = new_freq
+        self.orig_unit = orig_freq // gcd
+        self.new_unit = new_freq // gcd
+        self.lowpass_filter_width = lowpass_filter_width
+        self.rolloff = rolloff
+        # input samples an output block depends on beyond its own, rounded up to whole input units
+        width = math.ceil(lowpass_filter_width * self.orig_unit / (min(self.orig_unit, self.new_unit) * rolloff))
+        self.context = math.ceil((width + self.orig_unit) / self.orig_unit) * self.orig_unit
+        self.reset()
+
+    def reset(self):
+        self.buffer = torch.zeros(0)
+        self.buffer_start = 0
+        self.consumed = 0
+        self.total = 0
+
+    def _resample(self, end, output_end):
+        segment = self.buffer[:min(end + self.context, self.total) - self.buffer_start]
+        output = torchaudio.functional.resample(segment, self.orig_freq, self.new_freq,
+                                                lowpass_filter_width=self.lowpass_filter_width,
+                                                rolloff=self.rolloff)
+        offset = (self.consumed - self.buffer_start) // self.orig_unit * self.new_unit
+        output = output[offset:output_end - self.buffer_start // self.orig_unit * self.new_unit]
+        self.consumed = end
+        keep = max(0, end - self.context)
+        self.buffer = self.buffer[keep - self.buffer_start:]
+        self.buffer_start = keep
+        return output
+
+    def __call__(self, block):
+        block = torch.as_tensor(block, dtype=torch.float32)
+        self.buffer = torch.cat([self.buffer, block])
+        self.total += block.shape[-1]
+        end = (self.total - self.context) // self.orig_unit * self.orig_unit
+        if end <= self.consumed:
+            return torch.zeros(0)
+        return self._resample(end, end // self.orig_unit * self.new_unit)
+
+    def flush(self):
+        output = self._resample(self.total, math.ceil(self.total * self.new_unit / self.orig_unit))
+        self.reset()
+        return output
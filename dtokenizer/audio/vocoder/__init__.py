@@ -1,3 +1 @@
-from dtokenizer.audio.model.hubert_model import *
-from dtokenizer.audio.model.encodec_model import *
-from dtokenizer.audio.model.semanticodec_model import *
+from dtokenizer.audio.model import __getattr__, __all__
@@ -24,6 +24,14 @@ def get_padding(kernel_size, dilation=1):
     return (kernel_size * dilation - dilation) // 2
 
 
+def mask_padding(x, lengths):
+    # B x C x T with the frames past each sample's length zeroed, or x itself without lengths
+    if lengths is None:
+        return x
+    mask = torch.arange(x.shape[-1], device=x.device)[None, :] < lengths[:, None]
+    return x * mask.unsqueeze(1).to(x.dtype)
+
+
 class FairseqDropout(nn.Module):
     def __init__(self, p, module_name=None):
         super().__init__()
@@ -90,10 +98,15 @@ class VariancePredictor(nn.Module):
         self.ln2 = nn.LayerNorm(args.var_pred_hidden_dim)
         self.proj = nn.Linear(args.var_pred_hidden_dim, 1)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         # Input: B x T x C; Output: B x T
+        # mask (B x T) marks real frames, padding is zeroed before each conv like the conv's own padding
+        if mask is not None:
+            x = x.masked_fill(~mask.unsqueeze(-1), 0)
         x = self.conv1(x.transpose(1, 2)).transpose(1, 2)
         x = self.dropout_module(self.ln1(x))
+        if mask is not None:
+            x = x.masked_fill(~mask.unsqueeze(-1), 0)
         x = self.conv2(x.transpose(1, 2)).transpose(1, 2)
         x = self.dropout_module(self.ln2(x))
         return self.proj(x).squeeze(dim=2)
@@ -174,12 +187,12 @@ class ResBlock(torch.nn.Module):
         )
         self.convs2.apply(init_weights)
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
         for c1, c2 in zip(self.convs1, self.convs2):
             xt = F.leaky_relu(x, LRELU_SLOPE)
-            xt = c1(xt)
+            xt = c1(mask_padding(xt, lengths))
             xt = F.leaky_relu(xt, LRELU_SLOPE)
-            xt = c2(xt)
+            xt = c2(mask_padding(xt, lengths))
             x = xt + x
         return x
 
@@ -233,20 +246,24 @@ class Generator(torch.nn.Module):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
 
-    def forward(self, x):
-        x = self.conv_pre(x)
+    def forward(self, x, lengths=None):
+        # lengths (B) are the valid frames of samples padded to one length; padding is zeroed before
+        # every conv, so each sample sees the zeros its own conv padding would and matches an unpadded pass
+        x = self.conv_pre(mask_padding(x, lengths))
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, LRELU_SLOPE)
-            x = self.ups[i](x)
+            x = self.ups[i](mask_padding(x, lengths))
+            if lengths is not None:
+                lengths = lengths * self.ups[i].stride[0]
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
+                    xs = self.resblocks[i * self.num_kernels + j](x, lengths)
                 else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
+                    xs += self.resblocks[i * self.num_kernels + j](x, lengths)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
-        x = self.conv_post(x)
+        x = self.conv_post(mask_padding(x, lengths))
         x = torch.tanh(x)
 
         return x
@@ -308,17 +325,37 @@ class CodeHiFiGANModel(Generator):
         signal = signal.view(bsz, channels, max_frames)
         return signal
 
-    def forward(self, **kwargs):
+    @staticmethod
+    def _repeat_frames(x, dur):
+        # B x C x T -> B x C x T', every frame repeated dur times, shorter samples zero-padded
+        frames = [torch.repeat_interleave(x[i], dur[i], dim=1).transpose(0, 1) for i in range(x.size(0))]
+        x = nn.utils.rnn.pad_sequence(frames, batch_first=True).transpose(1, 2)
+        return x, dur.sum(dim=1)
+
+    def condition(self, **kwargs):
+        """
+        Build the Generator input from the codes and conditioning features.
+        Returns B x C x T' features and the number of valid frames of every sample, which is only
+        known after duration prediction (None when all samples keep the code length).
+        An optional code_mask (B x T) marks real codes when samples are padded to the same length.
+        """
         x = self.dict(kwargs["code"]).transpose(1, 2)
+        code_mask = kwargs.get("code_mask", None)
+        lengths = None if code_mask is None else code_mask.sum(dim=1)
 
         if self.dur_predictor and kwargs.get("dur_prediction", False):
-            assert x.size(0) == 1, "only support single sample"
-            log_dur_pred = self.dur_predictor(x.transpose(1, 2))
+            log_dur_pred = self.dur_predictor(x.transpose(1, 2), code_mask)
             dur_out = torch.clamp(
                 torch.round((torch.exp(log_dur_pred) - 1)).long(), min=1
             )
+            if code_mask is not None:
+                dur_out = dur_out.masked_fill(~code_mask, 0)
             # B x C x T
-            x = torch.repeat_interleave(x, dur_out.view(-1), dim=2)
+            if x.size(0) == 1:
+                x = torch.repeat_interleave(x, dur_out.view(-1), dim=2)
+                lengths = dur_out.sum(dim=1)
+            else:
+                x, lengths = self._repeat_frames(x, dur_out)
 
         if self.f0:
             if self.f0_quant_embed:
@@ -341,18 +378,40 @@ class CodeHiFiGANModel(Generator):
             x = torch.cat([x, spkr], dim=1)
 
         for k, feat in kwargs.items():
-            if k in ["spkr", "code", "f0", "dur_prediction"]:
+            if k in ["spkr", "code", "f0", "dur_prediction", "code_mask"]:
                 continue
 
             feat = self._upsample(feat, x.shape[-1])
             x = torch.cat([x, feat], dim=1)
 
+        # padded frames enter the Generator as zeros, as its own conv padding would
+        return mask_padding(x, lengths), lengths
+
+    def forward(self, **kwargs):
+        x, _ = self.condition(**kwargs)
         return super().forward(x)
 
 
+def stream_windows(synthesize, num_frames, chunk_frames, context_frames, fade_frames):
+    # synthesize(lo, hi) is the 1-D waveform of frames lo:hi, blocks are cut out of windows with context
+    tail = None
+    for start in range(0, num_frames, chunk_frames):
+        end = min(start + chunk_frames, num_frames)
+        lo, hi = max(0, start - context_frames), min(num_frames, end + context_frames)
+        wav = synthesize(lo, hi)
+        hop_size = wav.shape[-1] // (hi - lo)
+        fade = min(fade_frames, hi - end) * hop_size
+        block = wav[(start - lo) * hop_size:(end - lo) * hop_size + fade].clone()
+        if tail is not None:
+            ramp = torch.linspace(0, 1, tail.shape[-1], device=block.device, dtype=block.dtype)
+            block[:tail.shape[-1]] = tail * (1 - ramp) + block[:tail.shape[-1]] * ramp
+        tail = block[block.shape[-1] - fade:] if fade else None
+        yield block[:block.shape[-1] - fade]
+
+
 class CodeHiFiGANVocoder(nn.Module):
     def __init__(
-            self, checkpoint_path: str, model_cfg=None, fp16: bool = False
+            self, checkpoint_path: str, model_cfg=None, fp16: bool = False, state_dict=None
     ) -> None:
         super().__init__()
         if not model_cfg:
@@ -405,6 +464,14 @@ class CodeHiFiGANVocoder(nn.Module):
                 }
             }
             model_cfg = default_vocoder_cfg
+        if state_dict is not None:
+            # weights of a loaded vocoder, e.g. in shared memory, used in place by a model built around them
+            with torch.device('meta'):
+                self.model = CodeHiFiGANModel(model_cfg)
+                self.model.remove_weight_norm()
+            self.model.load_state_dict(state_dict, assign=True)
+            self.model.eval()
+            return
         self.model = CodeHiFiGANModel(model_cfg)
         state_dict = torch.load(checkpoint_path, map_location=torch.device('cpu'))
         self.model.load_state_dict(state_dict["generator"])
@@ -427,6 +494,49 @@ class CodeHiFiGANVocoder(nn.Module):
 
         return self.model(**x).detach().squeeze()
 
+    def stream(self, x: Dict[str, torch.Tensor], dur_prediction=False, chunk_frames=10, context_frames=16,
+               fade_frames=1):
+        """
+        Yield the waveform in blocks of chunk_frames frames as they are synthesized. Every window runs the
+        Generator with context_frames of neighbouring frames on each side, and consecutive blocks are
+        crossfaded over fade_frames frames. Durations are predicted for the whole sequence first, so
+        windows cut the expanded frames and blocks add up to the forward() length.
+        """
+        assert "code" in x
+        assert fade_frames <= context_frames, "crossfade needs frames computed past the end of each block"
+        x["dur_prediction"] = dur_prediction
+        # remove invalid code
+        mask = x["code"] >= 0
+        x["code"] = x["code"][mask].unsqueeze(dim=0)
+        if "f0" in x:
+            f0_up_ratio = x["f0"].size(1) // x["code"].size(1)
+            mask = mask.unsqueeze(2).repeat(1, 1, f0_up_ratio).view(-1, x["f0"].size(1))
+            x["f0"] = x["f0"][mask].unsqueeze(dim=0)
+
+        with torch.no_grad():
+            feat, _ = self.model.condition(**x)
+
+            def synthesize(lo, hi):
+                return Generator.forward(self.model, feat[:, :, lo:hi]).detach().view(-1)
+
+            yield from stream_windows(synthesize, feat.shape[-1], chunk_frames, context_frames, fade_frames)
+
+    def batch_forward(self, codes: List[torch.Tensor], dur_prediction=False) -> List[torch.Tensor]:
+        """
+        Synthesize several code sequences in one pass. Sequences are padded to the longest one and each
+        waveform is trimmed back to its own length. Padding is zeroed before every conv, so every waveform
+        equals its forward() output up to float rounding.
+        """
+        # remove invalid code
+        codes = [code[code >= 0] for code in codes]
+        lengths = torch.tensor([code.shape[0] for code in codes], device=codes[0].device)
+        code = nn.utils.rnn.pad_sequence(codes, batch_first=True, padding_value=0)
+        code_mask = torch.arange(code.shape[1], device=code.device)[None, :] < lengths[:, None]
+        x, frame_lengths = self.model.condition(code=code, code_mask=code_mask, dur_prediction=dur_prediction)
+        wav = Generator.forward(self.model, x, frame_lengths).detach()
+        hop_size = wav.shape[-1] // x.shape[-1]
+        return [w[0, :length * hop_size] for w, length in zip(wav, frame_lengths.tolist())]
+
     @classmethod
     def from_data_cfg(cls, args, data_cfg):
         vocoder_cfg = data_cfg.vocoder
@@ -436,10 +546,109 @@ class CodeHiFiGANVocoder(nn.Module):
         return cls(vocoder_cfg["checkpoint"], model_cfg, fp16=args.fp16)
 
 
+class _ScriptableCodeHiFiGAN(nn.Module):
+    # the traced graphs: forward maps codes to the waveform, durations predicts how often each code repeats
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, code, code_mask):
+        x = self.model.dict(code).transpose(1, 2) * code_mask.unsqueeze(1).to(self.model.dict.weight.dtype)
+        return Generator.forward(self.model, x, code_mask.sum(dim=1))
+
+    def durations(self, code, code_mask):
+        log_dur_pred = self.model.dur_predictor(self.model.dict(code), code_mask)
+        dur_out = torch.clamp(torch.round((torch.exp(log_dur_pred) - 1)).long(), min=1)
+        return dur_out.masked_fill(~code_mask, 0)
+
+
+# bumped whenever the traced graphs change, so graphs exported by older versions are traced again
+GRAPH_VERSION = 2
+
+
+def export_hifigan(vocoder: CodeHiFiGANVocoder, path: str) -> str:
+    """
+    Trace a loaded vocoder into a TorchScript file at path, holding the Generator with the code embedding
+    as forward(code, code_mask) and the duration predictor as a separate durations(code, code_mask) graph.
+    Expanding codes by their durations happens between the two, so both graphs accept any length.
+    Only unconditioned vocoders are supported, f0 and speaker inputs are not part of the graphs.
+    """
+    model = vocoder.model
+    if model.f0 or model.multispkr or model.embedder:
+        raise ValueError("only vocoders conditioned on codes alone can be exported")
+    module = _ScriptableCodeHiFiGAN(model).eval()
+    code = torch.randint(model.dict.num_embeddings, (2, 50))
+    code_mask = torch.ones(code.shape, dtype=torch.bool)
+    code_mask[1, 40:] = False
+    inputs = {'forward': (code, code_mask)}
+    if model.dur_predictor is not None:
+        inputs['durations'] = (code, code_mask)
+    with torch.no_grad():
+        traced = torch.jit.trace_module(module, inputs)
+    torch.jit.save(traced, path)
+    return path
+
+
+class ScriptedCodeHiFiGANVocoder(nn.Module):
+    """
+    Runs a vocoder exported by export_hifigan with the interface of CodeHiFiGANVocoder. Loading only
+    deserializes the graphs, the model code, checkpoint and weight norm removal are not involved.
+    """
+
+    def __init__(self, path: str, device='cpu') -> None:
+        super().__init__()
+        self.device = device
+        self.model = torch.jit.load(path, map_location=device)
+        self.model.eval()
+        self.has_dur_predictor = hasattr(self.model, 'durations')
+        logger.info(f"loaded scripted CodeHiFiGAN from {path}")
+
+    def _expand(self, code, dur_prediction):
+        # B x T codes, padded with 0 -> codes repeated by their predicted durations and the valid lengths
+        code = code.to(self.device)
+        lengths = (code >= 0).sum(dim=1)
+        code = code.clamp(min=0)
+        code_mask = torch.arange(code.shape[1], device=code.device)[None, :] < lengths[:, None]
+        if dur_prediction and self.has_dur_predictor:
+            dur = self.model.durations(code, code_mask)
+            code, lengths = CodeHiFiGANModel._repeat_frames(code.unsqueeze(1), dur)
+            code = code.squeeze(1)
+            code_mask = torch.arange(code.shape[1], device=code.device)[None, :] < lengths[:, None]
+        return code, code_mask, lengths
+
+    def forward(self, x: Dict[str, torch.Tensor], dur_prediction=False) -> torch.Tensor:
+        assert "code" in x
+        code = x["code"][x["code"] >= 0].unsqueeze(dim=0)
+        code, code_mask, _ = self._expand(code, dur_prediction)
+        return self.model(code, code_mask).detach().squeeze()
+
+    def stream(self, x: Dict[str, torch.Tensor], dur_prediction=False, chunk_frames=10, context_frames=16,
+               fade_frames=1):
+        """Yield the waveform in blocks like CodeHiFiGANVocoder.stream, windowing the expanded codes."""
+        assert "code" in x
+        assert fade_frames <= context_frames, "crossfade needs frames computed past the end of each block"
+        code = x["code"][x["code"] >= 0].unsqueeze(dim=0)
+        with torch.no_grad():
+            code, code_mask, _ = self._expand(code, dur_prediction)
+
+            def synthesize(lo, hi):
+                return self.model(code[:, lo:hi], code_mask[:, lo:hi]).detach().view(-1)
+
+            yield from stream_windows(synthesize, code.shape[1], chunk_frames, context_frames, fade_frames)
+
+    def batch_forward(self, codes: List[torch.Tensor], dur_prediction=False) -> List[torch.Tensor]:
+        codes = [code[code >= 0] for code in codes]
+        code = nn.utils.rnn.pad_sequence(codes, batch_first=True, padding_value=-1)
+        code, code_mask, lengths = self._expand(code, dur_prediction)
+        wav = self.model(code, code_mask).detach()
+        hop_size = wav.shape[-1] // code.shape[1]
+        return [w[0, :length * hop_size] for w, length in zip(wav, lengths.tolist())]
+
+
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-def load_hifigan(model_path, model_cfg=None, speaker_id=0, num_speakers=200):
-    vocoder = CodeHiFiGANVocoder(model_path, model_cfg)
+def load_hifigan(model_path, model_cfg=None, speaker_id=0, num_speakers=200, state_dict=None):
+    vocoder = CodeHiFiGANVocoder(model_path, model_cfg, state_dict=state_dict)
     multispkr = vocoder.model.multispkr
     if multispkr:
         assert (
@@ -449,3 +658,8 @@ def load_hifigan(model_path, model_cfg=None, speaker_id=0, num_speakers=200):
     vocoder.speaker_id = speaker_id
     vocoder.num_speakers = num_speakers
     return vocoder
+
+
+def load_scripted_hifigan(path, device='cpu'):
+    # CPU by default, like load_hifigan
+    return ScriptedCodeHiFiGANVocoder(path, device)
@@ -0,0 +1,159 @@
+import fcntl
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+from dtokenizer.interface import BaseTokenizer
+
+CACHE_DIR = os.environ.get('DTOKENIZER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'dtokenizer'))
+
+
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _compact(array):
+    if array.dtype.kind in 'iu' and array.size:
+        return array.astype(np.result_type(np.min_scalar_type(array.min()), np.min_scalar_type(array.max())))
+    return array
+
+
+def _pack(value):
+    # lists of numbers and integer arrays are stored as the smallest integer/float array that holds them
+    if isinstance(value, list) and value and all(isinstance(v, (int, float, np.number)) for v in value):
+        array = np.asarray(value)
+        return {'__units__': _compact(array), 'dtype': array.dtype.str, 'scalar': not isinstance(value[0], np.number)}
+    if isinstance(value, np.ndarray) and value.dtype.kind in 'iu':
+        return {'__units__': _compact(value), 'dtype': value.dtype.str, 'ndarray': True}
+    if isinstance(value, list):
+        return [_pack(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_pack(v) for v in value)
+    if isinstance(value, dict):
+        return {k: _pack(v) for k, v in value.items()}
+    return value
+
+
+def _unpack(value):
+    if isinstance(value, dict) and '__units__' in value:
+        array = value['__units__'].astype(np.dtype(value['dtype']))
+        if value.get('ndarray'):
+            return array
+        return array.tolist() if value['scalar'] else list(array)
+    if isinstance(value, list):
+        return [_unpack(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_unpack(v) for v in value)
+    if isinstance(value, dict):
+        return {k: _unpack(v) for k, v in value.items()}
+    return value
+
+
+class UnitCache(object):
+    '''
+    Persistent cache of tokenizer outputs, keyed by audio content and tokenizer settings.
+    Entries are written atomically and evicted least recently used first once the cache holds more than
+    max_bytes, so several processes can share one cache directory.
+    '''
+
+    def __init__(self, cache_dir=None, max_bytes=10 * 1024 ** 3, evict_every=100):
+        self.cache_dir = cache_dir or os.path.join(CACHE_DIR, 'units')
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.puts = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, input_file, namespace, **params):
+        settings = json.dumps({'namespace': namespace, 'params': params}, sort_keys=True, default=str)
+        return hashlib.sha256(f"{file_digest(input_file)}|{settings}".encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pkl')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            # the modification time is the recency used for eviction
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return _unpack(value)
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(_pack(value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        if self.puts % self.evict_every == 0:
+            self.evict()
+        self.puts += 1
+
+    def evict(self):
+        with open(os.path.join(self.cache_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            for sub in os.scandir(self.cache_dir):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    if entry.name.endswith('.pkl'):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class CachedTokenizer(BaseTokenizer):
+    '''
+    Wrap a tokenizer class so encode_file results are served from a UnitCache.
+    The tokenizer itself is only built on the first cache miss, so hits never load a model.
+    '''
+
+    def __init__(self, tokenizer_class, config, cache=None, **kwargs):
+        self.tokenizer_class = tokenizer_class
+        self.config = config
+        self.kwargs = kwargs
+        self.cache = cache if cache is not None else UnitCache()
+        self.namespace = f"{tokenizer_class.__module__}.{tokenizer_class.__name__}/{config}"
+        self._tokenizer = None
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = self.tokenizer_class(self.config, **self.kwargs)
+        return self._tokenizer
+
+    def encode(self, *args, **kwargs):
+        return self.tokenizer.encode(*args, **kwargs)
+
+    def encode_file(self, input_file, **params):
+        key = self.cache.key(input_file, self.namespace, tokenizer=self.kwargs, encode=params)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.tokenizer.encode_file(input_file, **params)
+            self.cache.put(key, result)
+        return result
+
+    def decode(self, *args, **kwargs):
+        return self.tokenizer.decode(*args, **kwargs)
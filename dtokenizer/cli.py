@@ -0,0 +1,254 @@
+import argparse
+import importlib
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+from tqdm import tqdm
+
+from dtokenizer.units import UnitReader, UnitWriter
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = 'index.json'
+FORMATS = ['jsonl', 'units']
+
+_tokenizer = None
+_encode_args = None
+_unit_args = None
+_batch_files = None
+
+
+def find_tokenizer(config):
+    '''The tokenizer class that registers config, searched across every tokenizer in dtokenizer.audio.model.'''
+    from dtokenizer.audio import model
+    for name in model.__all__:
+        tokenizer_class = getattr(model, name)
+        # tokenizers over several configs are not addressable by one config name, and pools run their own workers
+        if name.endswith(('MultiTokenizer', 'Pool')):
+            continue
+        if config in importlib.import_module(tokenizer_class.__module__).CONFIG:
+            return tokenizer_class
+    raise ValueError(f"config {config} is not registered by any tokenizer")
+
+
+def _takes_loader_workers(config):
+    '''Whether the factory of config takes a number of DataLoader processes as worker.'''
+    factory = getattr(importlib.import_module(find_tokenizer(config).__module__), 'CONFIG', {}).get(config)
+    return callable(factory) and 'worker' in inspect.signature(factory).parameters
+
+
+def read_manifest(path):
+    '''(id, audio path) of every non-empty line, either "path" or "id<TAB>path".'''
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            fields = line.split('\t')
+            entries.append((fields[0], fields[1]) if len(fields) > 1 else (str(len(entries)), fields[0]))
+    return entries
+
+
+def _json_default(value):
+    # tensors and numpy arrays from the codec backends
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _write_json(path, value):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(value, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _count_lines(path):
+    '''Number of complete lines in path, dropping a trailing line cut off by a crash.'''
+    with open(path, 'rb+') as f:
+        data = f.read()
+        complete = data.rfind(b'\n') + 1
+        if complete < len(data):
+            f.truncate(complete)
+    return data.count(b'\n', 0, complete)
+
+
+def _init_worker(config, tokenizer_args, encode_args, unit_args, batch_files):
+    global _tokenizer, _encode_args, _unit_args, _batch_files
+    _tokenizer = find_tokenizer(config)(config, **tokenizer_args)
+    _encode_args = encode_args
+    _unit_args = unit_args
+    _batch_files = batch_files
+
+
+def _encode_entries(entries):
+    '''
+    Yield (id, audio path, units, error) of every entry, encoding _batch_files files per batch_file_encode
+    call. A batch that fails is encoded again file by file, so an error only marks the file that caused it.
+    '''
+    for start in range(0, len(entries), _batch_files):
+        group = entries[start:start + _batch_files]
+        try:
+            results = [(result[0], None) for result in
+                       _tokenizer.batch_file_encode([audio_path for _, audio_path in group], **_encode_args)]
+        except Exception as e:
+            # usually one unreadable file, but a failure of the batching itself must not pass unnoticed
+            logger.warning(f"encoding {len(group)} files as a batch failed with {type(e).__name__}: {e}, "
+                           f"retrying them one by one")
+            results = []
+            for _, audio_path in group:
+                try:
+                    results.append((_tokenizer.encode_file(audio_path, **_encode_args)[0], None))
+                except Exception as e:
+                    results.append((None, f"{type(e).__name__}: {e}"))
+        for (uid, audio_path), (units, error) in zip(group, results):
+            yield uid, audio_path, units, error
+
+
+def _encode_units_shard(task):
+    '''Encode one shard into a unit store, which only appears once the whole shard is written.'''
+    shard, path, entries = task
+    if not os.path.exists(path):
+        with UnitWriter(path, **_unit_args) as writer:
+            for uid, audio_path, units, error in _encode_entries(entries):
+                if error is not None:
+                    writer.add(uid, [], path=audio_path, error=error)
+                else:
+                    writer.add(uid, units, path=audio_path)
+    errors = sum('error' in entry for entry in UnitReader(path).index)
+    return {'shard': shard, 'file': os.path.basename(path), 'count': len(entries), 'errors': errors}
+
+
+def _encode_shard(task):
+    '''Encode one shard, appending every result to a .partial file that is renamed once the shard is done.'''
+    shard, path, entries = task
+    if not os.path.exists(path):
+        partial_path = path + '.partial'
+        done = _count_lines(partial_path) if os.path.exists(partial_path) else 0
+        with open(partial_path, 'a') as f:
+            for uid, audio_path, units, error in _encode_entries(entries[done:]):
+                record = {'id': uid, 'path': audio_path}
+                if error is not None:
+                    record['error'] = error
+                else:
+                    record['units'] = units
+                f.write(json.dumps(record, default=_json_default) + '\n')
+                f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial_path, path)
+    errors = 0
+    with open(path) as f:
+        for line in f:
+            errors += 'error' in json.loads(line)
+    return {'shard': shard, 'file': os.path.basename(path), 'count': len(entries), 'errors': errors}
+
+
+def encode(manifest, output_dir, config, shard_size=1000, workers=1, tokenizer_args=None, encode_args=None,
+           output_format='jsonl', dtype='uint16', durations=False, batch_files=16):
+    '''
+    Encode every file of manifest with config into output_dir/shard-XXXXX.jsonl, one JSON record per line,
+    or with output_format='units' into one UnitWriter store of dtype units per shard, run-length encoded
+    when durations is set. Files are passed to the tokenizer's batch_file_encode batch_files at a time.
+    output_dir/index.json lists the finished shards and is rewritten after each one, so an interrupted run
+    resumes from the last finished shard, and for jsonl from the last written line within unfinished ones.
+    '''
+    if output_format not in FORMATS:
+        raise ValueError(f"output format {output_format} is not one of {FORMATS}")
+    tokenizer_args = tokenizer_args or {}
+    encode_args = encode_args or {}
+    unit_args = {'dtype': dtype, 'durations': durations} if output_format == 'units' else {}
+    find_tokenizer(config)
+    entries = read_manifest(manifest)
+    settings = {'manifest': os.path.abspath(manifest), 'config': config, 'tokenizer_args': tokenizer_args,
+                'encode_args': encode_args, 'format': output_format, 'unit_args': unit_args,
+                'shard_size': shard_size, 'total': len(entries)}
+
+    os.makedirs(output_dir, exist_ok=True)
+    index_path = os.path.join(output_dir, INDEX_FILE)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        previous = {k: index.get(k) for k in settings}
+        if previous != settings:
+            raise ValueError(f"{output_dir} holds a run with different settings: {previous}")
+    else:
+        index = dict(settings, shards=[])
+        _write_json(index_path, index)
+
+    finished = {s['shard'] for s in index['shards']}
+    extension = '.jsonl' if output_format == 'jsonl' else ''
+    tasks = [(shard, os.path.join(output_dir, f"shard-{shard:05d}{extension}"), entries[start:start + shard_size])
+             for shard, start in enumerate(range(0, len(entries), shard_size)) if shard not in finished]
+    encode_shard = _encode_shard if output_format == 'jsonl' else _encode_units_shard
+    initargs = (config, tokenizer_args, encode_args, unit_args, batch_files)
+    progress = tqdm(total=len(tasks) + len(finished), initial=len(finished), unit='shard')
+    if workers > 1 and len(tasks) > 1:
+        if _takes_loader_workers(config):
+            # pool workers are daemonic and cannot start DataLoader processes, the pool parallelizes instead
+            initargs = (config, dict({'worker': 0}, **tokenizer_args), encode_args, unit_args, batch_files)
+        # spawned, so every worker initializes its own CUDA context and model
+        pool = multiprocessing.get_context('spawn').Pool(min(workers, len(tasks)), _init_worker, initargs)
+        results = pool.imap_unordered(encode_shard, tasks)
+    else:
+        pool = None
+        if tasks:
+            _init_worker(*initargs)
+        results = map(encode_shard, tasks)
+    try:
+        for result in results:
+            index['shards'] = sorted(index['shards'] + [result], key=lambda s: s['shard'])
+            _write_json(index_path, index)
+            progress.update()
+        if pool is not None:
+            pool.close()
+    except BaseException:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        progress.close()
+        if pool is not None:
+            pool.join()
+    return index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='dtokenizer')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    encode_parser = subparsers.add_parser('encode', help='encode the audio files of a manifest into units')
+    encode_parser.add_argument('manifest', help='text file with one audio path, or "id<TAB>path", per line')
+    encode_parser.add_argument('output_dir')
+    encode_parser.add_argument('--config', required=True, help='tokenizer config, e.g. hubert_layer6_code100')
+    encode_parser.add_argument('--shard-size', type=int, default=1000)
+    encode_parser.add_argument('--workers', type=int, default=1, help='number of encoding processes')
+    encode_parser.add_argument('--tokenizer-args', type=json.loads, default={},
+                               help='JSON object of keyword arguments for the tokenizer')
+    encode_parser.add_argument('--encode-args', type=json.loads, default={},
+                               help='JSON object of keyword arguments for encode_file')
+    encode_parser.add_argument('--batch-files', type=int, default=16,
+                               help='number of files encoded together in one batch_file_encode call')
+    encode_parser.add_argument('--format', choices=FORMATS, default='jsonl',
+                               help='JSON lines, or memory-mapped unit stores read by dtokenizer.units.UnitReader')
+    encode_parser.add_argument('--dtype', default='uint16', help='integer type of units in the units format')
+    encode_parser.add_argument('--durations', action='store_true',
+                               help='store run-length encoded units and their durations in the units format')
+    args = parser.parse_args(argv)
+
+    try:
+        index = encode(args.manifest, args.output_dir, args.config, shard_size=args.shard_size,
+                       workers=args.workers, tokenizer_args=args.tokenizer_args, encode_args=args.encode_args,
+                       output_format=args.format, dtype=args.dtype, durations=args.durations,
+                       batch_files=args.batch_files)
+    except ValueError as e:
+        parser.error(str(e))
+    errors = sum(s['errors'] for s in index['shards'])
+    print(f"encoded {index['total']} files into {len(index['shards'])} shards, {errors} errors", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
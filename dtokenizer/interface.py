@@ -11,11 +11,11 @@ class BaseTokenizer:
     def decode(self, code):
         return code
 
-    def batch_encode(self, input_values):
-        return [self.encode(input_value) for input_value in input_values]
+    def batch_encode(self, input_values, *args):
+        return [self.encode(input_value, *args) for input_value in input_values]
 
-    def batch_file_encode(self, input_values):
-        return [self.encode_file(input_value) for input_value in input_values]
+    def batch_file_encode(self, input_values, **kwargs):
+        return [self.encode_file(input_value, **kwargs) for input_value in input_values]
 
     def batch_decode(self, codes):
         return [self.decode(code) for code in codes]
@@ -0,0 +1,145 @@
+import os
+import resource
+import sys
+import threading
+import time
+
+
+class _NullStage(object):
+    # shared by every stage while metrics are disabled, so instrumented code only pays for one check
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def update(self, **counts):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def peak_memory():
+    '''Peak CUDA memory allocated when CUDA is in use, otherwise the peak RSS of the process, in bytes.'''
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_initialized():
+        return torch.cuda.max_memory_allocated()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Stage(object):
+    __slots__ = ['registry', 'name', 'counts', 'start']
+
+    def __init__(self, registry, name, counts):
+        self.registry = registry
+        self.name = name
+        self.counts = counts
+
+    def __enter__(self):
+        self.registry._synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry._synchronize()
+        self.registry.record(self.name, time.perf_counter() - self.start, **self.counts)
+        return False
+
+    def update(self, **counts):
+        '''Add counts that are only known once the stage has run, e.g. the frames it produced.'''
+        for k, v in counts.items():
+            self.counts[k] = self.counts.get(k, 0) + v
+
+
+class Metrics(object):
+    '''
+    Registry of per-stage wall time, call counts, processed quantities (frames, samples, bytes, batch sizes)
+    and peak memory. Disabled by default, or enabled with DTOKENIZER_METRICS=1; while disabled stage()
+    returns a shared no-op context and nothing is recorded.
+    Callbacks get (stage, seconds, counts) for every recorded stage. Stages run in DataLoader worker
+    processes are recorded in those processes, use worker=0 to profile file loading.
+    '''
+
+    def __init__(self, enabled=False, synchronize=False):
+        self.enabled = enabled
+        # wait for queued CUDA kernels at stage boundaries, so GPU time is attributed to the right stage
+        self.synchronize = synchronize
+        self.callbacks = []
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def enable(self, synchronize=None):
+        self.enabled = True
+        if synchronize is not None:
+            self.synchronize = synchronize
+
+    def disable(self):
+        self.enabled = False
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def _synchronize(self):
+        torch = sys.modules.get('torch')
+        if self.synchronize and torch is not None and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+
+    def stage(self, name, **counts):
+        '''Context manager timing the block as stage name, with counts of what it processes.'''
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, counts)
+
+    def iterate(self, name, iterable):
+        '''Yield from iterable, timing every next() as stage name, e.g. to measure waiting on a DataLoader.'''
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record(self, name, seconds, **counts):
+        peak = peak_memory()
+        with self._lock:
+            stats = self._stats.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                                  'peak_bytes': 0})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['peak_bytes'] = max(stats['peak_bytes'], peak)
+            for k, v in counts.items():
+                stats[k] = stats.get(k, 0) + v
+        for callback in self.callbacks:
+            callback(name, seconds, counts)
+
+    def snapshot(self):
+        '''Totals of every stage since the last reset, as {stage: {'calls', 'seconds', 'frames', ...}}.'''
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def prometheus(self, prefix='dtokenizer'):
+        '''The snapshot in the Prometheus text exposition format, to serve from a scrape endpoint.'''
+        lines = []
+        for name, stats in sorted(self.snapshot().items()):
+            for k, v in sorted(stats.items()):
+                metric = f"{prefix}_stage_{k}" if k in ['peak_bytes', 'max_seconds'] else f"{prefix}_stage_{k}_total"
+                lines.append(f'{metric}{{stage="{name}"}} {v}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(enabled=os.environ.get('DTOKENIZER_METRICS', '0') not in ('', '0'))
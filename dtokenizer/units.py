@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+HEADER_FILE = 'header.json'
+VERSION = 1
+
+
+def run_length(units):
+    '''Collapse consecutive repeats of units, returning the deduplicated units and how often each repeats.'''
+    units = np.asarray(units)
+    if len(units) == 0:
+        return units, np.zeros(0, dtype=np.int32)
+    changes = np.any(units[1:] != units[:-1], axis=tuple(range(1, units.ndim))) if units.ndim > 1 \
+        else units[1:] != units[:-1]
+    starts = np.concatenate([[0], np.flatnonzero(changes) + 1])
+    return units[starts], np.diff(np.append(starts, len(units))).astype(np.int32)
+
+
+class UnitWriter(object):
+    '''
+    Write utterances of units into a directory read back by UnitReader:
+    units.bin holds every utterance's units back to back as dtype, offsets.npy where each one starts,
+    durations.bin the optional run lengths and index.jsonl the id and metadata of each utterance.
+    Nothing is visible at path until close(), so an interrupted writer never leaves a partial store.
+    '''
+
+    def __init__(self, path, dtype='uint16', durations=False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        if self.dtype.kind not in 'iu':
+            raise ValueError(f"units are stored as integers, not {self.dtype}")
+        self.durations = durations
+        self.frame_shape = None
+        self.offsets = [0]
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self._units = open(os.path.join(self.tmp_path, 'units.bin'), 'wb')
+        self._durations = open(os.path.join(self.tmp_path, 'durations.bin'), 'wb') if durations else None
+        self._index = open(os.path.join(self.tmp_path, 'index.jsonl'), 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, uid, units, durations=None, **metadata):
+        '''Append one utterance. With a durations store, units are run-length encoded unless durations is given.'''
+        units = np.asarray(units)
+        if units.ndim == 0:
+            raise ValueError(f"units of {uid} must be a sequence")
+        if len(units) == 0:
+            units = units.reshape((0,) + (self.frame_shape or ()))
+        elif self.frame_shape is None:
+            self.frame_shape = units.shape[1:]
+        if self.frame_shape is not None and units.shape[1:] != self.frame_shape:
+            raise ValueError(f"units of {uid} have frames of shape {units.shape[1:]}, expected {self.frame_shape}")
+        if units.size and (units.min() < np.iinfo(self.dtype).min or units.max() > np.iinfo(self.dtype).max):
+            raise ValueError(f"units of {uid} do not fit in {self.dtype}")
+        if self.durations:
+            if durations is None:
+                units, durations = run_length(units)
+            elif len(durations) != len(units):
+                raise ValueError(f"{uid} has {len(units)} units but {len(durations)} durations")
+            self._durations.write(np.asarray(durations, dtype=np.int32).tobytes())
+        elif durations is not None:
+            raise ValueError("this store was opened without durations")
+        self._units.write(units.astype(self.dtype).tobytes())
+        self._index.write(json.dumps(dict(metadata, id=uid)) + '\n')
+        self.offsets.append(self.offsets[-1] + len(units))
+
+    def close(self):
+        for f in [self._units, self._durations, self._index]:
+            if f is not None:
+                f.close()
+        np.save(os.path.join(self.tmp_path, 'offsets.npy'), np.asarray(self.offsets, dtype=np.int64))
+        with open(os.path.join(self.tmp_path, HEADER_FILE), 'w') as f:
+            json.dump({'version': VERSION, 'dtype': self.dtype.str, 'frame_shape': list(self.frame_shape or []),
+                       'durations': self.durations, 'count': len(self.offsets) - 1}, f)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        for f in [self._units, self._durations, self._index]:
+            if f is not None:
+                f.close()
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+class UnitReader(object):
+    '''
+    Random access to a store written by UnitWriter. Units and durations are memory-mapped, so reading an
+    utterance only touches its own pages, and reader[uid] or reader[i] returns a read-only array view.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, HEADER_FILE)) as f:
+            self.header = json.load(f)
+        if self.header['version'] > VERSION:
+            raise ValueError(f"{path} was written by a newer version of the unit format")
+        self.frame_shape = tuple(self.header['frame_shape'])
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.units = self._memmap('units.bin', self.header['dtype'], self.frame_shape)
+        self._durations = self._memmap('durations.bin', np.int32, ()) if self.header['durations'] else None
+        with open(os.path.join(path, 'index.jsonl')) as f:
+            self.index = [json.loads(line) for line in f]
+        self.ids = {entry['id']: i for i, entry in enumerate(self.index)}
+
+    def _memmap(self, name, dtype, frame_shape):
+        path = os.path.join(self.path, name)
+        if os.path.getsize(path) == 0:
+            # np.memmap refuses empty files
+            return np.zeros((0,) + frame_shape, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r').reshape((-1,) + frame_shape)
+
+    def __len__(self):
+        return len(self.index)
+
+    def _position(self, key):
+        return key if isinstance(key, (int, np.integer)) else self.ids[key]
+
+    def __getitem__(self, key):
+        i = self._position(key)
+        return self.units[self.offsets[i]:self.offsets[i + 1]]
+
+    def __contains__(self, uid):
+        return uid in self.ids
+
+    def __iter__(self):
+        for i, entry in enumerate(self.index):
+            yield entry['id'], self[i]
+
+    def durations(self, key):
+        if self._durations is None:
+            raise ValueError(f"{self.path} stores no durations")
+        i = self._position(key)
+        return self._durations[self.offsets[i]:self.offsets[i + 1]]
+
+    def expand(self, key):
+        '''Units repeated by their durations, i.e. one unit per frame again.'''
+        units = self[key]
+        return units if self._durations is None else np.repeat(units, self.durations(key), axis=0)
+
+    def metadata(self, key):
+        entry = dict(self.index[self._position(key)])
+        del entry['id']
+        return entry
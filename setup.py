@@ -23,5 +23,11 @@ setup(
     keywords='tokenizer',
     packages=find_packages(),
     install_requires=required,
+    extras_require={
+        'onnx': ['onnx', 'onnxruntime'],
+    },
+    entry_points={
+        'console_scripts': ['dtokenizer=dtokenizer.cli:main'],
+    },
     zip_safe=False,
 )
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from dtokenizer.aio import AsyncBatcher, AsyncTokenizer
+from dtokenizer.interface import BaseTokenizer
+
+
+class RecordingTokenizer(BaseTokenizer):
+    def __init__(self):
+        self.batches = []
+
+    def encode(self, speech, sampling_rate):
+        if speech is None:
+            raise ValueError("no speech")
+        return [x * sampling_rate for x in speech], None
+
+    def batch_encode(self, speeches, sampling_rate):
+        self.batches.append(len(speeches))
+        return super().batch_encode(speeches, sampling_rate)
+
+    def decode(self, code):
+        return sum(code)
+
+
+def test_concurrent_calls_are_batched():
+    tokenizer = RecordingTokenizer()
+
+    async def run():
+        async with AsyncTokenizer(tokenizer, max_batch=4, max_wait=0.05) as client:
+            encoded = await asyncio.gather(*[client.encode([i], 2 if i % 2 else 1) for i in range(8)])
+            decoded = await asyncio.gather(*[client.decode([i, i]) for i in range(3)])
+            return encoded, decoded
+
+    encoded, decoded = asyncio.run(run())
+    assert encoded == [([i * (2 if i % 2 else 1)], None) for i in range(8)]
+    assert decoded == [0, 2, 4]
+    # two batches of 4 calls, each split by sampling rate
+    assert tokenizer.batches == [2, 2, 2, 2]
+
+
+def test_errors_only_reach_their_call():
+    tokenizer = RecordingTokenizer()
+
+    async def run():
+        async with AsyncTokenizer(tokenizer, max_batch=8, max_wait=0.05) as client:
+            return await asyncio.gather(client.encode([1], 1), client.encode(None, 1), client.encode([3], 1),
+                                        return_exceptions=True)
+
+    good, bad, other = asyncio.run(run())
+    assert good == ([1], None) and other == ([3], None)
+    assert isinstance(bad, ValueError)
+
+
+def test_lone_call_waits_at_most_max_wait():
+    async def run():
+        async with AsyncTokenizer(RecordingTokenizer(), max_batch=16, max_wait=0.01) as client:
+            return await asyncio.wait_for(client.encode([1], 1), timeout=1)
+
+    assert asyncio.run(run()) == ([1], None)
+
+
+def test_closed_tokenizer_rejects_calls():
+    async def run():
+        client = AsyncTokenizer(RecordingTokenizer())
+        await client.encode([1], 1)
+        await client.close()
+        await client.encode([1], 1)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
+
+
+def test_close_fails_running_batch():
+    started, release = threading.Event(), threading.Event()
+
+    def batch_fn(items):
+        started.set()
+        release.wait()
+        return items
+
+    async def run():
+        executor = ThreadPoolExecutor(max_workers=1)
+        batcher = AsyncBatcher(batch_fn, executor, max_batch=4, max_wait=0)
+        call = asyncio.ensure_future(batcher(1))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        await batcher.close()
+        try:
+            return await asyncio.wait_for(call, timeout=2)
+        finally:
+            release.set()
+            executor.shutdown()
+
+    with pytest.raises(RuntimeError, match='closed'):
+        asyncio.run(run())
@@ -0,0 +1,52 @@
+import shutil
+
+import joblib
+import nlp2
+import numpy as np
+import pytest
+from sklearn.cluster import KMeans
+
+from dtokenizer import artifact
+from dtokenizer.cache import file_digest
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    km = KMeans(n_clusters=4, n_init=1, random_state=0).fit(np.random.RandomState(0).randn(64, 8))
+    joblib.dump(km, tmp_path / 'km.bin')
+    downloads = []
+
+    def download_file(url, outdir, filename):
+        downloads.append(url)
+        shutil.copy(url, f"{outdir}/{filename}")
+
+    monkeypatch.setattr(artifact, 'ARTIFACT_DIR', str(tmp_path / 'artifacts'))
+    monkeypatch.setattr(nlp2, 'download_file', download_file)
+    return km, str(tmp_path / 'km.bin'), downloads
+
+
+def test_fetch_centroids_installs_once(store):
+    km, url, downloads = store
+    path = artifact.fetch_centroids(url, 'km.bin')
+    assert artifact.fetch_centroids(url, 'km.bin') == path
+    assert downloads == [url]
+    centroids = np.load(path, mmap_mode='r')
+    assert isinstance(centroids, np.memmap)
+    assert np.array_equal(centroids, km.cluster_centers_)
+
+
+def test_fetch_verifies_checksum(store, monkeypatch):
+    _, url, downloads = store
+    with pytest.raises(ValueError):
+        artifact.fetch(url, 'km.bin', sha256='0' * 64)
+    assert artifact.fetch(url, 'km.bin', sha256=file_digest(url))
+    # a corrupted install is downloaded again
+    with open(artifact.fetch(url, 'km.bin'), 'ab') as f:
+        f.write(b'garbage')
+    assert file_digest(artifact.fetch(url, 'km.bin')) == file_digest(url)
+    assert len(downloads) == 3
+
+    monkeypatch.setenv('DTOKENIZER_OFFLINE', '1')
+    assert artifact.fetch(url, 'km.bin')
+    with pytest.raises(FileNotFoundError):
+        artifact.fetch(url, 'other.bin')
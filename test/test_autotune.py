@@ -0,0 +1,35 @@
+import time
+
+import pytest
+
+from dtokenizer.audio import autotune
+
+
+def test_autotune_stops_at_cpu_allocation_failure_and_caches(tmp_path, monkeypatch):
+    monkeypatch.setattr(autotune, 'CACHE_DIR', str(tmp_path))
+    calls = []
+
+    def forward(batch):
+        calls.append(batch.shape[0])
+        if batch.shape[0] >= 8:
+            raise RuntimeError("[enforce fail at alloc_cpu.cpp:117] DefaultCPUAllocator: can't allocate memory")
+        # a fixed cost per call, so every doubling of the batch doubles the throughput
+        time.sleep(0.01)
+
+    assert autotune.autotune_batch(forward, 100, 'cpu', 'fake') == 4
+    assert calls == [1, 1, 2, 4, 8]
+    # later runs read the cached result instead of probing
+    assert autotune.autotune_batch(lambda batch: pytest.fail('probed again'), 100, 'cpu', 'fake') == 4
+    assert autotune.autotune_batch(forward, 100, 'cpu', 'other', max_batch=2) == 2
+    assert len(autotune._read_cache(autotune._cache_path())) == 2
+
+
+def test_autotune_raises_other_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr(autotune, 'CACHE_DIR', str(tmp_path))
+
+    def forward(batch):
+        if batch.shape[0] >= 2:
+            raise RuntimeError("mat1 and mat2 shapes cannot be multiplied")
+
+    with pytest.raises(RuntimeError):
+        autotune.autotune_batch(forward, 100, 'cpu', 'fake')
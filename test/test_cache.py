@@ -0,0 +1,47 @@
+import os
+import pickle
+
+import numpy as np
+
+from dtokenizer.cache import UnitCache, CachedTokenizer
+
+
+class CountingTokenizer:
+    built = 0
+
+    def __init__(self, config):
+        CountingTokenizer.built += 1
+
+    def encode_file(self, input_file, top_k=5):
+        return [np.int64(3), np.int64(70000), np.int64(top_k)], None
+
+
+def test_cached_tokenizer_skips_model_on_hit(tmp_path):
+    audio = tmp_path / 'audio.wav'
+    audio.write_bytes(b'RIFF0000')
+    cache = UnitCache(str(tmp_path / 'cache'))
+    first = CachedTokenizer(CountingTokenizer, 'config', cache=cache).encode_file(str(audio))
+    second = CachedTokenizer(CountingTokenizer, 'config', cache=cache).encode_file(str(audio))
+    assert CountingTokenizer.built == 1
+    assert first == second and type(second[0][0]) is np.int64
+    assert CachedTokenizer(CountingTokenizer, 'config', cache=cache).encode_file(str(audio), top_k=3)[0][2] == 3
+    assert CountingTokenizer.built == 2
+
+
+def test_unit_cache_evicts_least_recently_used(tmp_path):
+    cache = UnitCache(str(tmp_path), max_bytes=600, evict_every=1)
+    for i in range(10):
+        cache.put(f"{i:064x}", list(range(100)))
+    kept = [f for _, _, files in os.walk(tmp_path) for f in files if f.endswith('.pkl')]
+    assert 0 < len(kept) < 10
+    assert cache.get(f"{9:064x}") == list(range(100))
+
+
+def test_unit_cache_compacts_integer_arrays(tmp_path):
+    cache = UnitCache(str(tmp_path))
+    codes = np.arange(0, 50000, 7, dtype=np.int64)
+    cache.put(f"{1:064x}", (codes, None))
+    result, _ = cache.get(f"{1:064x}")
+    assert result.dtype == np.int64 and np.array_equal(result, codes)
+    with open(cache._path(f"{1:064x}"), 'rb') as f:
+        assert pickle.load(f)[0]['__units__'].dtype == np.uint16
@@ -0,0 +1,141 @@
+import json
+import multiprocessing as mp
+import os
+from types import SimpleNamespace
+
+import pytest
+import soundfile
+import torch
+
+from dtokenizer import cli
+from dtokenizer.audio.model.hubert_model import HubertTokenizer, configuration_hubert
+from dtokenizer.audio.model.hubert_model.modeling_hubert import _Speech2Code
+from dtokenizer.interface import BaseTokenizer
+from dtokenizer.units import UnitReader
+from test_speech2code import tiny_encoder
+
+
+class LengthTokenizer(BaseTokenizer):
+    calls = []
+    batches = []
+
+    def __init__(self, config):
+        self.config = config
+
+    def encode_file(self, input_file):
+        LengthTokenizer.calls.append(input_file)
+        if input_file.endswith('bad'):
+            raise RuntimeError('unreadable')
+        return [len(input_file)], None
+
+    def batch_file_encode(self, input_files):
+        LengthTokenizer.batches.append(len(input_files))
+        return super().batch_file_encode(input_files)
+
+
+@pytest.fixture
+def manifest(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, 'find_tokenizer', lambda config: LengthTokenizer)
+    LengthTokenizer.calls = []
+    LengthTokenizer.batches = []
+    path = tmp_path / 'manifest.tsv'
+    path.write_text(''.join(f"utt{i}\t/audio/{'x' * i}{'bad' if i == 3 else ''}\n" for i in range(7)))
+    return str(path)
+
+
+def read_output(output_dir):
+    records = []
+    for shard in sorted(f for f in os.listdir(output_dir) if f.endswith('.jsonl')):
+        with open(os.path.join(output_dir, shard)) as f:
+            records.extend(json.loads(line) for line in f)
+    return records
+
+
+def test_encode_shards_and_index(manifest, tmp_path):
+    output_dir = str(tmp_path / 'out')
+    index = cli.encode(manifest, output_dir, 'fake', shard_size=3, batch_files=2)
+    assert [s['count'] for s in index['shards']] == [3, 3, 1]
+    # the batch holding the bad file is retried file by file
+    assert LengthTokenizer.batches == [2, 1, 2, 1, 1]
+    assert LengthTokenizer.calls.count('/audio/xxxbad') == 2 and LengthTokenizer.calls.count('/audio/xxxx') == 1
+    assert [s['errors'] for s in index['shards']] == [0, 1, 0]
+    records = read_output(output_dir)
+    assert [r['id'] for r in records] == [f"utt{i}" for i in range(7)]
+    assert records[1]['units'] == [len('/audio/x')] and 'error' in records[3]
+
+    # a finished run encodes nothing again
+    LengthTokenizer.calls = []
+    cli.encode(manifest, output_dir, 'fake', shard_size=3)
+    assert LengthTokenizer.calls == []
+    with pytest.raises(ValueError):
+        cli.encode(manifest, output_dir, 'fake', shard_size=2)
+
+
+def test_encode_resumes_interrupted_shard(manifest, tmp_path):
+    output_dir = str(tmp_path / 'out')
+    cli.encode(manifest, output_dir, 'fake', shard_size=3)
+    expected = read_output(output_dir)
+
+    # crash in the middle of the second shard: the first is indexed, the second half-written
+    with open(os.path.join(output_dir, cli.INDEX_FILE)) as f:
+        index = json.load(f)
+    index['shards'] = index['shards'][:1]
+    with open(os.path.join(output_dir, cli.INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+    with open(os.path.join(output_dir, 'shard-00001.jsonl')) as f:
+        lines = f.readlines()
+    os.remove(os.path.join(output_dir, 'shard-00001.jsonl'))
+    os.remove(os.path.join(output_dir, 'shard-00002.jsonl'))
+    with open(os.path.join(output_dir, 'shard-00001.jsonl.partial'), 'w') as f:
+        f.write(lines[0] + lines[1][:5])
+
+    LengthTokenizer.calls = []
+    index = cli.encode(manifest, output_dir, 'fake', shard_size=3)
+    assert len(LengthTokenizer.calls) == 3
+    assert len(index['shards']) == 3
+    assert read_output(output_dir) == expected
+
+
+def test_encode_units_format(manifest, tmp_path):
+    output_dir = str(tmp_path / 'out')
+    index = cli.encode(manifest, output_dir, 'fake', shard_size=3, output_format='units')
+    assert [s['errors'] for s in index['shards']] == [0, 1, 0]
+    reader = UnitReader(os.path.join(output_dir, index['shards'][0]['file']))
+    assert reader['utt2'].tolist() == [len('/audio/xx')]
+    assert reader.metadata('utt2') == {'path': '/audio/xx'}
+
+
+class RecordingSpeech2Code(_Speech2Code):
+    # number of files of every call that went through, appended to log from any process
+    log = None
+
+    def __call__(self, filepaths=None, **kwargs):
+        result = super().__call__(filepaths=filepaths, **kwargs)
+        with open(self.log, 'a') as f:
+            f.write(f"{len(filepaths)}\n")
+        return result
+
+
+def test_pooled_encode_keeps_batches(tmp_path, monkeypatch):
+    sc = tiny_encoder(tmp_path)
+    sc.close()
+    RecordingSpeech2Code.log = str(tmp_path / 'calls.txt')
+
+    def tiny(worker=2):
+        # a budget of one second per pass, so every file is a DataLoader batch of its own
+        return RecordingSpeech2Code(sc.hubert_model, sc.km_path, 2, chunk_sec=1, batch=1, worker=worker)
+
+    monkeypatch.setitem(configuration_hubert.CONFIG, 'tiny', tiny)
+    monkeypatch.setattr(cli, 'find_tokenizer', lambda config: HubertTokenizer)
+    # forked, so the workers see the config registered above; pool workers are daemonic either way
+    monkeypatch.setattr(cli, 'multiprocessing', SimpleNamespace(get_context=lambda method: mp.get_context('fork')))
+    manifest = tmp_path / 'manifest.tsv'
+    torch.manual_seed(0)
+    with open(manifest, 'w') as f:
+        for i, length in enumerate([16000, 24000, 20000, 30000]):
+            soundfile.write(str(tmp_path / f"{i}.wav"), (torch.randn(length) * 0.1).numpy(), 16000)
+            f.write(f"utt{i}\t{tmp_path / f'{i}.wav'}\n")
+    index = cli.encode(str(manifest), str(tmp_path / 'out'), 'tiny', shard_size=2, workers=2)
+    assert [s['errors'] for s in index['shards']] == [0, 0]
+    with open(RecordingSpeech2Code.log) as f:
+        assert sorted(int(line) for line in f) == [2, 2]
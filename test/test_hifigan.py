@@ -0,0 +1,59 @@
+import torch
+
+from dtokenizer.audio.vocoder.hifigan import CodeHiFiGANModel, export_hifigan, load_hifigan, load_scripted_hifigan
+
+CONFIG = {"upsample_rates": [5, 4, 4, 2, 2], "upsample_kernel_sizes": [11, 8, 8, 4, 4],
+          "upsample_initial_channel": 32, "resblock_kernel_sizes": [3, 7],
+          "resblock_dilation_sizes": [[1, 3, 5], [1, 3, 5]], "num_embeddings": 20, "embedding_dim": 16,
+          "model_in_dim": 16, "dur_predictor_params": {"encoder_embed_dim": 16, "var_pred_hidden_dim": 16,
+                                                       "var_pred_kernel_size": 3, "var_pred_dropout": 0.5}}
+
+
+def tiny_vocoder(tmp_path):
+    torch.manual_seed(0)
+    checkpoint = str(tmp_path / 'vocoder.pt')
+    torch.save({'generator': CodeHiFiGANModel(CONFIG).state_dict()}, checkpoint)
+    return load_hifigan(checkpoint, CONFIG)
+
+
+def test_scripted_vocoder_matches_eager(tmp_path):
+    vocoder = tiny_vocoder(tmp_path)
+    scripted = load_scripted_hifigan(export_hifigan(vocoder, str(tmp_path / 'vocoder.scripted.pt')))
+    # the same device as the eager vocoder, which takes the CPU code tensors _Code2Speech builds
+    assert {p.device for p in scripted.parameters()} == {p.device for p in vocoder.parameters()}
+
+    codes = [torch.randint(20, (length,)) for length in [23, 9]]
+    with torch.no_grad():
+        for dur_prediction in [False, True]:
+            expected = vocoder({'code': codes[0].view(1, -1)}, dur_prediction=dur_prediction)
+            result = scripted({'code': codes[0].view(1, -1)}, dur_prediction=dur_prediction)
+            assert torch.allclose(result, expected, atol=1e-5)
+            streamed = torch.cat(list(scripted.stream({'code': codes[0].view(1, -1)}, dur_prediction=dur_prediction)))
+            assert streamed.shape == expected.shape
+            batches = [model.batch_forward(codes, dur_prediction) for model in [vocoder, scripted]]
+            for e, r in zip(*batches):
+                assert torch.allclose(r, e, atol=1e-5)
+
+
+
+def test_batch_forward_matches_forward(tmp_path):
+    vocoder = tiny_vocoder(tmp_path)
+    codes = [torch.randint(20, (length,)) for length in [80, 30, 57]]
+    with torch.no_grad():
+        for dur_prediction in [False, True]:
+            expected = [vocoder({'code': code.view(1, -1)}, dur_prediction=dur_prediction) for code in codes]
+            for e, r in zip(expected, vocoder.batch_forward(codes, dur_prediction)):
+                assert r.shape == e.shape
+                # including the last frames of the shorter sequences, next to the padding
+                assert (r - e).abs().max() <= 1e-4 * e.abs().max()
+
+
+def test_stream_matches_forward(tmp_path):
+    vocoder = tiny_vocoder(tmp_path)
+    code = torch.randint(20, (47,))
+    with torch.no_grad():
+        for dur_prediction in [False, True]:
+            expected = vocoder({'code': code.view(1, -1)}, dur_prediction=dur_prediction)
+            blocks = list(vocoder.stream({'code': code.view(1, -1)}, dur_prediction=dur_prediction, chunk_frames=10))
+            assert len(blocks) > 1
+            assert torch.allclose(torch.cat(blocks), expected, atol=1e-6)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+import torch
+from transformers import Wav2Vec2FeatureExtractor
+
+from dtokenizer import artifact
+from dtokenizer.audio.model.hubert_model.modeling_hubert import load_speech2code
+from test_hubert_truncate import tiny_hubert
+
+pytest.importorskip('onnxruntime')
+
+
+def test_onnx_backend_matches_torch(tmp_path, monkeypatch):
+    monkeypatch.setattr(artifact, 'ARTIFACT_DIR', str(tmp_path / 'artifacts'))
+    hubert_path = str(tmp_path / 'hubert')
+    tiny_hubert().save_pretrained(hubert_path)
+    Wav2Vec2FeatureExtractor(do_normalize=False).save_pretrained(hubert_path)
+    km_path = str(tmp_path / 'centroids.npy')
+    np.save(km_path, np.random.RandomState(0).randn(20, 32).astype(np.float32))
+
+    torch.manual_seed(0)
+    speech = [torch.randn(16000) * 0.1, torch.randn(27000) * 0.1]
+    encoders = [load_speech2code(hubert_path, km_path, 2, backend=backend, batch=2) for backend in ['torch', 'onnx']]
+    for beamsearch in [False, True]:
+        expected, result = [sc(input_values=speech, beamsearch=beamsearch) for sc in encoders]
+        for e, r in zip(expected, result):
+            assert np.array_equal(r['code'], e['code'])
+            assert np.array_equal(r['merged_code'], e['merged_code'])
+    with pytest.raises(ValueError):
+        encoders[1](input_values=speech, feat_norm=True)
+    with pytest.raises(ValueError):
+        load_speech2code(hubert_path, km_path, 2, backend='tensorrt')
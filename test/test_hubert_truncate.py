@@ -0,0 +1,25 @@
+import torch
+from transformers import HubertConfig, HubertModel
+
+from dtokenizer.audio.model.hubert_model.modeling_hubert import truncate_hubert
+
+
+def tiny_hubert(stable=False):
+    torch.manual_seed(0)
+    config = HubertConfig(hidden_size=32, num_hidden_layers=4, num_attention_heads=2, intermediate_size=64,
+                          num_conv_pos_embeddings=16, num_conv_pos_embedding_groups=2,
+                          do_stable_layer_norm=stable, feat_extract_norm='layer' if stable else 'group')
+    return HubertModel(config).eval()
+
+
+def test_truncated_forward_matches_hidden_states():
+    for stable in [False, True]:
+        model = tiny_hubert(stable)
+        speech = torch.randn(2, 8000)
+        with torch.no_grad():
+            hidden_states = model(speech, output_hidden_states=True).hidden_states
+            for layer in range(1, 4):
+                truncated = truncate_hubert(model, layer)
+                assert len(truncated.encoder.layers) == layer
+                assert torch.allclose(truncated(speech).last_hidden_state, hidden_states[layer], atol=1e-5)
+        assert len(model.encoder.layers) == 4
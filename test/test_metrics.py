@@ -0,0 +1,32 @@
+from dtokenizer.metrics import Metrics
+
+
+def test_disabled_records_nothing():
+    metrics = Metrics()
+    with metrics.stage('forward', frames=10) as stage:
+        stage.update(samples=5)
+    assert list(metrics.iterate('input', [1, 2])) == [1, 2]
+    assert metrics.snapshot() == {}
+
+
+def test_stages_counts_and_callbacks():
+    metrics = Metrics(enabled=True)
+    seen = []
+    metrics.add_callback(lambda name, seconds, counts: seen.append((name, counts)))
+    for batch in [2, 3]:
+        with metrics.stage('forward', batch=batch) as stage:
+            stage.update(frames=10 * batch)
+    assert list(metrics.iterate('input', 'ab')) == ['a', 'b']
+
+    snapshot = metrics.snapshot()
+    assert snapshot['forward']['calls'] == 2
+    assert snapshot['forward']['batch'] == 5 and snapshot['forward']['frames'] == 50
+    assert snapshot['forward']['seconds'] >= snapshot['forward']['max_seconds'] > 0
+    assert snapshot['forward']['peak_bytes'] > 0
+    # the exhausting next() is timed as well
+    assert snapshot['input']['calls'] == 3
+    assert seen[0] == ('forward', {'batch': 2, 'frames': 20})
+    assert 'dtokenizer_stage_frames_total{stage="forward"} 50' in metrics.prometheus()
+
+    metrics.reset()
+    assert metrics.snapshot() == {}
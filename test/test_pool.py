@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import soundfile
+import torch
+from transformers import Wav2Vec2FeatureExtractor
+
+from dtokenizer.audio.model.hubert_model import HubertTokenizer, HubertTokenizerPool
+from dtokenizer.audio.model.hubert_model import configuration_hubert, modeling_hubert
+from dtokenizer.audio.model.hubert_model.modeling_hubert import _Speech2Code, load_backbone, share_entry
+from dtokenizer.audio.registry import shared_registry
+from test_hubert_truncate import tiny_hubert
+
+
+def tiny_config(tmp_path):
+    hubert_path = str(tmp_path / 'hubert')
+    tiny_hubert().save_pretrained(hubert_path)
+    Wav2Vec2FeatureExtractor(do_normalize=False).save_pretrained(hubert_path)
+    km_path = str(tmp_path / 'centroids.npy')
+    np.save(km_path, np.random.RandomState(0).randn(20, 32).astype(np.float32))
+    return lambda worker=0, batch=1: _Speech2Code(hubert_path, km_path, 2, batch=batch, worker=worker)
+
+
+def test_shared_backbone_matches_loaded(tmp_path):
+    config = tiny_config(tmp_path)
+    sc = config()
+    key = sc.registry_keys[-1]
+    state_dict = share_entry(key)
+    assert all(tensor.is_shared() for tensor in state_dict.values())
+    model = load_backbone(sc.hubert_model, 'cpu', state_dict=state_dict)
+    assert all(p.data_ptr() == state_dict[name].data_ptr() for name, p in model.state_dict().items())
+    speech = torch.randn(1, 8000)
+    with torch.no_grad():
+        assert torch.equal(model(speech).last_hidden_state, shared_registry.get(key)(speech).last_hidden_state)
+    sc.close()
+
+
+def test_pool_results_are_ordered(tmp_path, monkeypatch):
+    monkeypatch.setitem(configuration_hubert.CONFIG, 'tiny', tiny_config(tmp_path))
+    torch.manual_seed(0)
+    files = []
+    for i, length in enumerate([16000, 4000, 24000, 8000]):
+        files.append(str(tmp_path / f"{i}.wav"))
+        soundfile.write(files[-1], (torch.randn(length) * 0.1).numpy(), 16000)
+    tokenizer = HubertTokenizer('tiny')
+    expected = [tokenizer.encode_file(f)[0].tolist() for f in files]
+    # forked, so the workers see the config registered above
+    with HubertTokenizerPool('tiny', workers=2, start_method='fork') as pool:
+        assert [code.tolist() for code, _ in pool.encode_files(files)] == expected
+    tokenizer.close()
+
+
+def _worker_max_batch(_):
+    return configuration_hubert._pool_tokenizer.sc.max_batch
+
+
+def test_pool_workers_reuse_the_parent_batch(tmp_path, monkeypatch):
+    config = tiny_config(tmp_path)
+    probes = str(tmp_path / 'probes.txt')
+
+    def autotune_batch(*args):
+        with open(probes, 'a') as f:
+            f.write(f"{os.getpid()}\n")
+        return 3
+
+    monkeypatch.setattr(modeling_hubert, 'autotune_batch', autotune_batch)
+    monkeypatch.setitem(configuration_hubert.CONFIG, 'tiny', lambda worker=0, batch=None: config(worker, batch))
+    with HubertTokenizerPool('tiny', workers=2, start_method='fork') as pool:
+        assert pool.pool.map(_worker_max_batch, range(4)) == [3] * 4
+    # only the parent probed
+    with open(probes) as f:
+        assert f.read().splitlines() == [str(os.getpid())]
+
+
+def test_pool_is_exported_with_the_tokenizers():
+    from dtokenizer.audio import HubertTokenizerPool as exported
+    from dtokenizer.cli import find_tokenizer
+    assert exported is HubertTokenizerPool
+    assert find_tokenizer('hubert_layer6_code100') is HubertTokenizer
@@ -0,0 +1,169 @@
+import asyncio
+import gc
+
+import numpy as np
+import soundfile
+import torch
+from transformers import Wav2Vec2FeatureExtractor
+
+from dtokenizer.aio import AsyncTokenizer
+from dtokenizer.audio.model.hubert_model import HubertTokenizer, configuration_hubert
+from dtokenizer.audio.model.hubert_model.modeling_hubert import SpeechCodes, _MultiSpeech2Code, _Speech2Code
+from dtokenizer.audio.registry import SharedRegistry, shared_registry
+from test_hubert_truncate import tiny_hubert
+
+
+def tiny_encoder(tmp_path, normalize=False, **kwargs):
+    hubert_path = str(tmp_path / 'hubert')
+    tiny_hubert().save_pretrained(hubert_path)
+    Wav2Vec2FeatureExtractor(do_normalize=normalize).save_pretrained(hubert_path)
+    km_path = str(tmp_path / 'centroids.npy')
+    np.save(km_path, np.random.RandomState(0).randn(20, 32).astype(np.float32))
+    kwargs.setdefault('batch', 4)
+    return _Speech2Code(hubert_path, km_path, 2, **kwargs)
+
+
+def test_batched_codes_match_single_input(tmp_path):
+    sc = tiny_encoder(tmp_path)
+    assert sc.config.feat_extract_norm == 'group'
+    torch.manual_seed(0)
+    speech = [torch.randn(16000) * 0.1, torch.randn(40000) * 0.1, torch.randn(16000) * 0.1]
+    batched = sc(input_values=speech)
+    for s, result in zip(speech, batched):
+        assert np.array_equal(result['code'], sc(input_values=[s])['code'])
+    sc.close()
+
+
+def test_iter_file_matches_whole_file(tmp_path):
+    torch.manual_seed(0)
+    for normalize in [False, True]:
+        sc = tiny_encoder(tmp_path, normalize=normalize, chunk_sec=2, batch=2)
+        for sampling_rate in [16000, 44100]:
+            path = str(tmp_path / f"speech{sampling_rate}.wav")
+            # a tail under a second, which is merged into the last window
+            soundfile.write(path, (torch.randn(int(sampling_rate * 6.4)) * 0.1 + 0.05).numpy(), sampling_rate)
+            windows = list(sc.iter_file(path))
+            assert len(windows) == 3
+            expected = sc(filepaths=[path])['code']
+            assert np.array_equal(np.concatenate([window['code'] for window in windows]), expected)
+        sc.close()
+
+
+def test_stream_agrees_with_whole_utterance(tmp_path):
+    sc = tiny_encoder(tmp_path)
+    torch.manual_seed(0)
+    speech = torch.randn(16000 * 6) * 0.1
+    expected = sc(input_values=[speech])['code']
+    stream = sc.stream()
+    for _ in range(2):
+        emitted = [stream.feed(block) for block in torch.split(speech, 1600)]
+        # codes become final while audio is still arriving, about one step plus the lookahead behind it
+        assert sum(map(len, emitted[:20])) > 0
+        codes = [code for block in emitted for code in block] + stream.flush()
+        assert len(codes) == len(expected)
+        # only the context each window sees differs from the whole utterance
+        assert (np.array(codes) == expected).mean() > 0.95
+    sc.close()
+
+
+def test_registry_shares_and_releases_weights(tmp_path):
+    first = tiny_encoder(tmp_path)
+    second = _Speech2Code(first.hubert_model, first.km_path, 3, batch=4)
+    keys = first.registry_keys
+    assert keys == second.registry_keys
+    assert all(shared_registry.refcount(key) == 2 for key in keys)
+    assert second.processor is first.processor and second.C is first.C
+    # views truncated to different layers over one backbone
+    assert second.model.encoder.layers[0] is first.model.encoder.layers[0]
+    first.close()
+    first.close()
+    assert all(shared_registry.refcount(key) == 1 for key in keys)
+    # dropping the last tokenizer releases its entries too
+    del second
+    gc.collect()
+    assert not any(key in shared_registry for key in keys)
+
+
+def test_registry_builds_once_per_key():
+    registry = SharedRegistry()
+    built = []
+    assert registry.acquire('a', lambda: built.append(1) or 'value') == 'value'
+    assert registry.acquire('a', lambda: built.append(2) or 'other') == 'value'
+    assert built == [1] and registry.refcount('a') == 2
+    registry.release('a', 'missing')
+    assert registry.get('a') == 'value'
+    registry.release('a')
+    assert 'a' not in registry and len(registry) == 0
+
+
+def test_multi_head_codes_match_single_heads(tmp_path):
+    sc = tiny_encoder(tmp_path)
+    km_path = str(tmp_path / 'centroids50.npy')
+    np.save(km_path, np.random.RandomState(1).randn(50, 32).astype(np.float32))
+    heads = {'layer2': (sc.km_path, 2), 'layer3': (km_path, 3)}
+    multi = _MultiSpeech2Code(sc.hubert_model, heads, batch=4)
+    torch.manual_seed(0)
+    speech = [torch.randn(16000) * 0.1, torch.randn(40000) * 0.1]
+    results = multi(input_values=speech, beamsearch=True)
+    for name, (path, layer) in heads.items():
+        single = _Speech2Code(sc.hubert_model, path, layer, batch=4)
+        for result, expected in zip(results, single(input_values=speech, beamsearch=True)):
+            assert np.array_equal(result[name]['code'], expected['code'])
+            assert np.array_equal(result[name]['beam_code'], expected['beam_code'])
+        single.close()
+    multi.close()
+    sc.close()
+
+
+class SumVocoder(object):
+    closed = False
+
+    def __call__(self, code):
+        return sum(code)
+
+    def close(self):
+        self.closed = True
+
+
+def test_decode_only_tokenizer_skips_encoder(monkeypatch):
+    def encoder(**kwargs):
+        raise AssertionError('encoder loaded')
+
+    monkeypatch.setitem(configuration_hubert.CONFIG, 'tiny', encoder)
+    monkeypatch.setitem(configuration_hubert.VOCODERS, 'tiny', lambda scripted_vocoder: SumVocoder())
+    tokenizer = HubertTokenizer('tiny')
+    assert tokenizer.decode([1, 2]) == 3
+    tokenizer.close()
+    assert tokenizer.cs.closed
+
+
+def test_quantization_report_ignores_other_backend_arguments(tmp_path, monkeypatch):
+    sc = tiny_encoder(tmp_path)
+    monkeypatch.setitem(configuration_hubert.KMEANS, 'tiny', lambda: (sc.hubert_model, sc.km_path, 2))
+    monkeypatch.setitem(configuration_hubert.CONFIG, 'tiny', None)
+    path = str(tmp_path / 'speech.wav')
+    torch.manual_seed(0)
+    soundfile.write(path, (torch.randn(16000) * 0.1).numpy(), 16000)
+    report = HubertTokenizer('tiny', backend='onnx', batch=1, worker=0).quantization_report([path])
+    assert report['frames'] == 49 and 0 <= report['code_agreement'] <= 1
+    sc.close()
+
+
+def test_encode_matches_batch_encode(tmp_path, monkeypatch):
+    sc = tiny_encoder(tmp_path)
+    monkeypatch.setitem(configuration_hubert.CONFIG, 'tiny', lambda: sc)
+    tokenizer = HubertTokenizer('tiny')
+    torch.manual_seed(0)
+    speech = [torch.randn(16000) * 0.1, torch.randn(24000) * 0.1]
+    batched = tokenizer.batch_encode(speech, 16000)
+
+    async def encode_async():
+        async with AsyncTokenizer(tokenizer) as client:
+            return await asyncio.gather(*[client.encode(s, 16000) for s in speech])
+
+    for s, (result, _), (async_result, _) in zip(speech, batched, asyncio.run(encode_async())):
+        expected, _ = tokenizer.encode(s, 16000)
+        assert isinstance(expected, SpeechCodes) and isinstance(result, SpeechCodes)
+        assert np.array_equal(result['code'], expected['code'])
+        assert np.array_equal(async_result['code'], expected['code'])
+    tokenizer.close()
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from dtokenizer.units import UnitReader, UnitWriter, run_length
+
+
+def test_round_trip_with_durations(tmp_path):
+    rng = np.random.RandomState(0)
+    utterances = {f"utt{i}": rng.randint(0, 5, size=rng.randint(0, 50)) for i in range(20)}
+    path = str(tmp_path / 'units')
+    with UnitWriter(path, dtype='uint16', durations=True) as writer:
+        for uid, units in utterances.items():
+            writer.add(uid, units, speaker=uid[-1])
+
+    reader = UnitReader(path)
+    assert len(reader) == 20 and 'utt3' in reader
+    for uid in reversed(list(utterances)):
+        units, durations = run_length(utterances[uid])
+        assert reader[uid].dtype == np.uint16
+        assert np.array_equal(reader[uid], units)
+        assert np.array_equal(reader.durations(uid), durations)
+        assert np.array_equal(reader.expand(uid), utterances[uid])
+        assert reader.metadata(uid) == {'speaker': uid[-1]}
+    assert [uid for uid, _ in reader] == list(utterances)
+
+
+def test_frames_and_validation(tmp_path):
+    path = str(tmp_path / 'units')
+    codes = np.arange(24).reshape(3, 8)
+    with UnitWriter(path, dtype='int32') as writer:
+        writer.add('failed', [], error='unreadable')
+        writer.add('a', codes)
+        with pytest.raises(ValueError):
+            writer.add('b', np.zeros((2, 4)))
+        with pytest.raises(ValueError):
+            writer.add('c', [1], durations=[1])
+    reader = UnitReader(path)
+    assert np.array_equal(reader['a'], codes)
+    assert reader['failed'].shape == (0, 8)
+
+    with UnitWriter(str(tmp_path / 'small'), dtype='uint8') as writer:
+        with pytest.raises(ValueError):
+            writer.add('a', [256])
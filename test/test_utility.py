@@ -0,0 +1,80 @@
+from itertools import groupby
+
+import numpy as np
+import torch
+import torchaudio
+
+from dtokenizer.audio.utility import nearest_centroids, beam_search_units, length_batches, StreamResampler, \
+    quantize_centroids
+
+
+def test_nearest_centroids_matches_full_distance_matrix():
+    torch.manual_seed(0)
+    feature = torch.randn(1000, 16)
+    centroids = torch.randn(16, 50)
+    centroid_norm = (centroids ** 2).sum(0, keepdim=True)
+    dist = torch.cdist(feature, centroids.T)
+    expected = torch.topk(dist, 5, dim=-1, largest=False)
+    indices, distances = nearest_centroids(feature, centroids, centroid_norm, top_k=5, block_size=128)
+    assert torch.equal(indices, expected.indices)
+    assert torch.allclose(distances, expected.values, atol=1e-4)
+    indices, distances = nearest_centroids(feature, centroids, centroid_norm, block_size=128)
+    assert indices.shape == (1000, 1)
+    assert torch.equal(indices[:, 0], dist.argmin(-1))
+
+
+def test_quantized_centroids_mostly_agree():
+    torch.manual_seed(0)
+    feature = torch.randn(1000, 16)
+    centroids = torch.randn(16, 50)
+    centroid_norm = (centroids ** 2).sum(0, keepdim=True)
+    indices, _ = nearest_centroids(feature, centroids, centroid_norm)
+    quantized_indices, distances = nearest_centroids(feature, quantize_centroids(centroids), centroid_norm, top_k=5)
+    assert quantized_indices.shape == (1000, 5)
+    assert (quantized_indices[:, 0] == indices[:, 0]).float().mean() > 0.95
+    assert torch.allclose(distances[:, 0], torch.cdist(feature, centroids.T).min(-1).values, atol=0.2)
+
+
+def reference_beam_search(indices, distances, beamsize):
+    sequences = [[[], 1.0]]
+    for i_row, v_row in zip(indices, distances):
+        all_candidates = list()
+        for tokens, score in sequences:
+            for k, v in zip(i_row, v_row):
+                norm_len_rate = (len(indices) / len([k for k, _ in groupby(tokens + [k])]))
+                norm_dist_rate = np.var(v_row) / v
+                all_candidates.append([tokens + [k], score + norm_len_rate * norm_dist_rate])
+        sequences = sorted(all_candidates, key=lambda tup: tup[1], reverse=True)[:beamsize]
+    return sequences[0][0]
+
+
+def test_beam_search_units_matches_reference():
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        frames = rng.randint(1, 60)
+        indices = rng.randint(0, 4, size=(frames, 3))
+        distances = np.sort(rng.rand(frames, 3).astype(np.float32) + 0.1, axis=1)
+        sequence, frame_var = beam_search_units(indices, distances, beamsize=4)
+        assert list(sequence) == reference_beam_search(indices, distances, 4)
+        assert len(frame_var) == frames
+
+
+def test_length_batches_respects_padded_budget():
+    lengths = [5, 100, 7, 60, 100, 3, 250]
+    batches = length_batches(lengths, 200)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    assert [6] in batches
+    for batch in batches:
+        assert len(batch) == 1 or len(batch) * max(lengths[i] for i in batch) <= 200
+    for batch in length_batches([100, 60, 100, 60, 60], 400, exact=True):
+        assert len({[100, 60, 100, 60, 60][i] for i in batch}) == 1
+
+
+def test_stream_resampler_matches_whole_signal():
+    torch.manual_seed(0)
+    for orig_freq, new_freq in [(44100, 16000), (8000, 16000), (48000, 16000)]:
+        signal = torch.randn(orig_freq * 2 + 123)
+        resampler = StreamResampler(orig_freq, new_freq)
+        blocks = [resampler(block) for block in torch.split(signal, 3000)] + [resampler.flush()]
+        expected = torchaudio.functional.resample(signal, orig_freq, new_freq)
+        assert torch.allclose(torch.cat(blocks), expected, atol=1e-5)